@@ -0,0 +1,199 @@
+import time
+import uuid
+import bisect
+import threading
+from datetime import datetime
+import topic_cache
+
+def _since(since_date):
+    return since_date if isinstance(since_date, datetime) else datetime.fromisoformat(str(since_date))
+
+class FakeDatabase:
+    """Remplaçant en mémoire des fonctions de mysql_client utilisées par le bot
+
+    Chaque appel compte pour un aller-retour MySQL et peut simuler une latence.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._topics = {}          # topic_id -> dict
+        self._user_topics = {}     # user_id -> [topic_id] par date de création
+        self._messages = []        # dicts, id = position + 1
+        self._by_user = {}         # user_id -> [index]
+        self._by_topic = {}        # topic_id -> [index]
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # --- Écritures
+
+    def init_database(self):
+        self._round_trip()
+
+    def create_topic(self, user_id, username, title, created_at=None):
+        self._round_trip()
+        topic_id = str(uuid.uuid4())
+        with self._lock:
+            self._topics[topic_id] = {
+                "topic_id": topic_id, "user_id": user_id, "title": title,
+                "created_at": created_at or datetime.utcnow(),
+                "summary": None, "summary_message_id": 0, "centroid": None, "centroid_count": 0,
+            }
+            self._user_topics.setdefault(user_id, []).append(topic_id)
+        topic_cache.remember(user_id, topic_id, title)
+        return topic_id
+
+    def create_new_topic(self, user_id, username, title):
+        return self.create_topic(user_id, username, title)
+
+    def insert_messages(self, rows):
+        self._round_trip()
+        with self._lock:
+            for topic_id, user_id, username, message_user, message_bot, timestamp in rows:
+                index = len(self._messages)
+                self._messages.append({
+                    "id": index + 1, "topic_id": topic_id, "user_id": user_id, "username": username,
+                    "message_user": message_user, "message_bot": message_bot, "timestamp": timestamp,
+                })
+                self._by_user.setdefault(user_id, []).append(index)
+                self._by_topic.setdefault(topic_id, []).append(index)
+        return len(rows)
+
+    def insert_message(self, user_id, user_message, bot_reply, username=None, topic_id=None):
+        self.insert_messages([(topic_id, user_id, username or "Unknown", user_message, bot_reply, datetime.utcnow())])
+
+    def update_topic_summary(self, topic_id, summary, last_message_id):
+        self._round_trip()
+        topic = self._topics[topic_id]
+        if topic["summary_message_id"] < last_message_id:
+            topic.update(summary=summary, summary_message_id=last_message_id)
+
+    def update_topic_centroids(self, rows):
+        self._round_trip()
+        for topic_id, centroid, count in rows:
+            self._topics[topic_id].update(centroid=centroid, centroid_count=count)
+
+    # --- Lectures
+
+    def get_or_create_active_topic(self, user_id, username, message_content):
+        self._round_trip()
+        topic_ids = self._user_topics.get(user_id)
+        if topic_ids:
+            topic = self._topics[topic_ids[-1]]
+            return topic["topic_id"], topic["title"]
+        title = message_content[:50] + "..." if len(message_content) > 50 else message_content
+        return self.create_topic(user_id, username, title), title
+
+    def get_user_topics(self, user_id):
+        self._round_trip()
+        topics = [self._topics[t] for t in reversed(self._user_topics.get(user_id, []))]
+        return [(t["topic_id"], t["title"], t["created_at"]) for t in topics]
+
+    def get_messages_by_topic(self, topic_id, limit=None):
+        self._round_trip()
+        rows = [self._messages[i] for i in self._by_topic.get(topic_id, [])]
+        if limit is not None:
+            rows = rows[-limit:]
+        return [(m["message_user"], m["message_bot"], m["timestamp"], m["username"]) for m in rows]
+
+    def _title(self, topic_id):
+        topic = self._topics.get(topic_id)
+        return topic["title"] if topic else "Conversation sans sujet"
+
+    def get_history_page(self, user_id, since_date, after=None, limit=500):
+        self._round_trip()
+        since = _since(since_date)
+        rows = []
+        for index in self._by_user.get(user_id, []):
+            m = self._messages[index]
+            if m["timestamp"] < since or (after and (m["timestamp"], m["id"]) <= after):
+                continue
+            rows.append((m["id"], m["message_user"], m["message_bot"], m["timestamp"],
+                         self._title(m["topic_id"]), m["topic_id"] or "default"))
+        rows.sort(key=lambda row: (row[3], row[0]))
+        return rows[:limit]
+
+    def get_topics_active_since(self, user_id, since_date):
+        self._round_trip()
+        since = _since(since_date)
+        result = []
+        for topic_id in self._user_topics.get(user_id, []):
+            indices = self._by_topic.get(topic_id, [])
+            if indices and self._messages[indices[-1]]["timestamp"] >= since:
+                t = self._topics[topic_id]
+                whole_topic = int(min(self._messages[i]["timestamp"] for i in indices) >= since)
+                result.append((topic_id, t["title"], t["summary"], t["summary_message_id"], whole_topic))
+        if any(self._messages[i]["topic_id"] is None and self._messages[i]["timestamp"] >= since
+               for i in self._by_user.get(user_id, [])):
+            result.append((None, "Conversation sans sujet", None, 0, 0))
+        return result
+
+    def _topic_indices(self, topic_id, user_id):
+        if topic_id is None:
+            return [i for i in self._by_user.get(user_id, []) if self._messages[i]["topic_id"] is None]
+        return self._by_topic.get(topic_id, [])
+
+    def get_topic_tail(self, topic_id, since_date, limit, user_id=None):
+        self._round_trip()
+        since = _since(since_date)
+        rows = [self._messages[i] for i in self._topic_indices(topic_id, user_id)]
+        rows = [m for m in rows if m["timestamp"] >= since][-limit:]
+        return [(m["id"], m["message_user"], m["message_bot"], m["timestamp"]) for m in rows]
+
+    def get_topic_messages_between(self, topic_id, after_id, before_id=None, limit=500, since_date=None,
+                                   user_id=None):
+        self._round_trip()
+        since = _since(since_date or "1970-01-01")
+        indices = self._topic_indices(topic_id, user_id)
+        start = bisect.bisect_right(indices, after_id - 1)
+        rows = []
+        for index in indices[start:]:
+            m = self._messages[index]
+            if before_id is not None and m["id"] >= before_id:
+                break
+            if m["timestamp"] < since:
+                continue
+            rows.append((m["id"], m["message_user"], m["message_bot"], m["timestamp"]))
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def search_messages(self, user_id, terms, limit=10, offset=0):
+        self._round_trip()
+        words = terms.lower().split()
+        hits = []
+        for index in self._by_user.get(user_id, []):
+            m = self._messages[index]
+            text = f"{m['message_user']} {m['message_bot']}".lower()
+            score = sum(text.count(word) for word in words)
+            if score:
+                hits.append((m["id"], m["message_user"], m["message_bot"], m["timestamp"],
+                             self._title(m["topic_id"]), float(score)))
+        hits.sort(key=lambda row: (-row[5], -row[0]))
+        return hits[offset:offset + limit]
+
+    def get_topic_centroids(self, user_id):
+        self._round_trip()
+        return [(t["topic_id"], t["title"], t["centroid"], t["centroid_count"])
+                for t in (self._topics[i] for i in self._user_topics.get(user_id, []))]
+
+    def get_user_messages_after(self, user_id, after_id, limit=500):
+        self._round_trip()
+        indices = self._by_user.get(user_id, [])
+        start = bisect.bisect_right(indices, after_id - 1)
+        return [(self._messages[i]["id"], self._messages[i]["message_user"], self._messages[i]["message_bot"])
+                for i in indices[start:start + limit]]
+
+    def get_messages_by_ids(self, user_id, message_ids):
+        self._round_trip()
+        result = {}
+        for message_id in message_ids:
+            m = self._messages[message_id - 1]
+            if m["user_id"] == user_id:
+                result[message_id] = (m["message_user"], m["message_bot"], m["timestamp"])
+        return result
@@ -0,0 +1,135 @@
+import json
+import time
+import asyncio
+import hashlib
+import numpy as np
+from aiohttp import web
+
+EMBED_DIM = 256
+
+def fake_embedding(text, dim=EMBED_DIM):
+    """Sac de mots haché : deux textes qui partagent des mots ont des vecteurs proches"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in text.lower().split():
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0
+    return vector.tolist()
+
+class FakeOllama:
+    """Serveur Ollama local : génère `tokens` mots espacés de `token_latency` secondes"""
+
+    def __init__(self, tokens=60, token_latency=0.02, prompt_latency=0.05):
+        self.tokens = tokens
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.requests = 0
+
+    def _stats(self, prompt_chars, started):
+        elapsed = int((time.perf_counter() - started) * 1e9)
+        return {
+            "done": True,
+            "total_duration": elapsed,
+            "load_duration": 0,
+            "prompt_eval_count": prompt_chars // 4,
+            "prompt_eval_duration": int(self.prompt_latency * 1e9),
+            "eval_count": self.tokens,
+            "eval_duration": max(0, elapsed - int(self.prompt_latency * 1e9)),
+        }
+
+    async def _generate(self, request, chat):
+        self.requests += 1
+        body = await request.json()
+        if chat:
+            prompt_chars = sum(len(m["content"]) for m in body["messages"])
+        else:
+            prompt_chars = len(body.get("prompt") or "")
+            if not body.get("prompt"):
+                # Requête de chargement du modèle (keep_alive)
+                return web.json_response({"model": body["model"], "response": "", "done": True})
+
+        started = time.perf_counter()
+        await asyncio.sleep(self.prompt_latency)
+        words = [f"mot{i}" for i in range(self.tokens)]
+
+        def chunk(text):
+            if chat:
+                return {"message": {"role": "assistant", "content": text}, "done": False}
+            return {"response": text, "done": False}
+
+        if not body.get("stream", True):
+            await asyncio.sleep(self.token_latency * self.tokens)
+            result = chunk(" ".join(words))
+            result.update(self._stats(prompt_chars, started))
+            return web.json_response(result)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(self.token_latency)
+            await response.write((json.dumps(chunk(word + " ")) + "\n").encode("utf-8"))
+        final = chunk("")
+        final.update(self._stats(prompt_chars, started))
+        await response.write((json.dumps(final) + "\n").encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def chat(self, request):
+        return await self._generate(request, chat=True)
+
+    async def generate(self, request):
+        return await self._generate(request, chat=False)
+
+    async def tags(self, request):
+        return web.json_response({"models": [{"name": "mistral:latest"}, {"name": "nomic-embed-text:latest"}]})
+
+    async def version(self, request):
+        return web.json_response({"version": "bench"})
+
+    async def embeddings(self, request):
+        body = await request.json()
+        return web.json_response({"embedding": fake_embedding(body["prompt"])})
+
+    async def embed(self, request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({"embeddings": [fake_embedding(text) for text in inputs]})
+
+class FakeOpenAI:
+    """Point d'accès /v1/chat/completions qui répond après `latency` secondes"""
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+        self.requests = 0
+
+    async def completions(self, request):
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        return web.json_response({
+            "id": f"chatcmpl-bench-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "Analyse simulée : tout est correct."},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 8, "total_tokens": prompt_tokens + 8},
+        })
+
+async def start_fake_services(port, ollama, openai_stub):
+    """Démarre Ollama et OpenAI simulés sur le même port local"""
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/api/chat", ollama.chat)
+    app.router.add_post("/api/generate", ollama.generate)
+    app.router.add_get("/api/tags", ollama.tags)
+    app.router.add_get("/api/version", ollama.version)
+    app.router.add_post("/api/embeddings", ollama.embeddings)
+    app.router.add_post("/api/embed", ollama.embed)
+    app.router.add_post("/v1/chat/completions", openai_stub.completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
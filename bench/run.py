@@ -0,0 +1,283 @@
+"""Banc de charge hors ligne du bot
+
+    python -m bench.run --scenario burst --users 50 --messages 4
+
+Ollama et OpenAI sont simulés par un serveur HTTP local, Redis par fakeredis et
+MySQL par une base en mémoire qui compte les allers-retours. Les handlers du
+bot (handle_message, use_gpt) sont appelés avec des mises à jour Telegram
+synthétiques.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+SCENARIOS = {
+    # Beaucoup d'utilisateurs qui écrivent en même temps
+    "burst": {"users": 100, "messages": 3, "concurrency": 100, "history": 0, "topics": 1, "gpt": 0},
+    # Historique volumineux par utilisateur, puis /useGPT sur toute la période
+    "long_history": {"users": 10, "messages": 5, "concurrency": 10, "history": 5000, "topics": 3, "gpt": 1},
+    # Beaucoup de sujets par utilisateur : routage et analyse par sujet
+    "many_topics": {"users": 20, "messages": 5, "concurrency": 20, "history": 400, "topics": 100, "gpt": 1},
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Banc de charge TalkWise")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="burst")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--messages", type=int, help="messages par utilisateur")
+    parser.add_argument("--concurrency", type=int, help="handlers exécutés simultanément")
+    parser.add_argument("--history", type=int, help="messages pré-chargés par utilisateur")
+    parser.add_argument("--topics", type=int, help="sujets pré-chargés par utilisateur")
+    parser.add_argument("--gpt", type=int, help="appels /useGPT par utilisateur")
+    parser.add_argument("--tokens", type=int, default=60, help="tokens générés par réponse")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="secondes par token")
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.001, help="secondes par aller-retour MySQL")
+    parser.add_argument("--parallel", type=int, default=4, help="OLLAMA_NUM_PARALLEL simulé")
+    parser.add_argument("--no-stream", action="store_true", help="réponses Mistral non progressives")
+    parser.add_argument("--json", action="store_true", help="rapport au format JSON")
+    args = parser.parse_args()
+    for key, value in SCENARIOS[args.scenario].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def configure_environment(args, port, workdir):
+    """Variables lues à l'import des modules du bot : à définir avant de les importer"""
+    os.environ.update({
+        "OLLAMA_URL": f"http://127.0.0.1:{port}",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "OLLAMA_NUM_PARALLEL": str(args.parallel),
+        "OLLAMA_STREAM": "0" if args.no_stream else "1",
+        "OLLAMA_WARM_INTERVAL": "0",
+        "STREAM_EDIT_INTERVAL": "0.5",
+        "LLM_MAX_QUEUE": str(max(100, args.users * 2)),
+        "VECTOR_INDEX_DIR": os.path.join(workdir, "vectors"),
+        "WRITE_BEHIND_SPILL_PATH": os.path.join(workdir, "spill.jsonl"),
+        "WRITE_BEHIND_FLUSH_INTERVAL": "0.2",
+        "METRICS_ENABLED": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+
+def install_stand_ins(database):
+    """Remplace Redis et les fonctions MySQL dans tous les modules du bot déjà importés"""
+    import mysql_client
+    import redis_client
+    import fakeredis
+    from fakeredis import aioredis as fake_aioredis
+
+    # Clients texte et binaire sur le même serveur simulé, comme en production
+    server = fakeredis.FakeServer()
+    fake_redis = fake_aioredis.FakeRedis(server=server, decode_responses=True)
+    fake_binary = fake_aioredis.FakeRedis(server=server, decode_responses=False)
+    real_redis, real_binary = redis_client.r, redis_client.rb
+    # Références d'origine relevées avant tout remplacement (mysql_client compris)
+    real_functions = {name: value for name, value in vars(mysql_client).items() if hasattr(database, name)}
+    for module in list(sys.modules.values()):
+        names = getattr(module, "__dict__", {})
+        if names.get("r") is real_redis:
+            module.r = fake_redis
+        if names.get("rb") is real_binary:
+            module.rb = fake_binary
+        for name, value in list(names.items()):
+            if name in real_functions and value is real_functions[name]:
+                setattr(module, name, getattr(database, name))
+
+# --- Telegram simulé
+
+class FakeMessage:
+    def __init__(self, text, user, recorder, chat_id):
+        self.text = text
+        self.from_user = user
+        self.chat_id = chat_id
+        self._recorder = recorder
+
+    async def reply_text(self, text, **kwargs):
+        self._recorder.sent(text)
+        return FakeMessage(text, None, self._recorder, self.chat_id)
+
+    async def edit_text(self, text, **kwargs):
+        self._recorder.sent(text)
+        self.text = text
+        return self
+
+class Recorder:
+    """Mesure le délai avant la première réponse visible (hors message d'attente)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_visible = None
+        self.sends = 0
+
+    def sent(self, text):
+        self.sends += 1
+        if self.first_visible is None and not text.startswith(("✍️", "⏳", "📥")):
+            self.first_visible = time.perf_counter() - self.started
+
+def make_update(user_id, text, recorder):
+    user = SimpleNamespace(id=user_id, username=f"bench{user_id}", first_name="Bench")
+    message = FakeMessage(text, user, recorder, chat_id=user_id)
+    return SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=user_id), effective_user=user)
+
+# --- Données et charge
+
+VOCABULARY = ("python docker redis mysql cuisine recette voyage japon budget football musique guitare "
+              "jardin tomates impôts retraite vélo montagne photo objectif serveur réseau").split()
+
+def topic_words(topic_index):
+    rng = random.Random(topic_index)
+    return rng.sample(VOCABULARY, 4)
+
+def synthetic_question(rng, topic_index):
+    words = topic_words(topic_index)
+    return f"Question sur {' '.join(rng.sample(words, 3))} numéro {rng.randint(1, 10**6)} ?"
+
+def preload(database, args, start_date):
+    """Historique pré-existant : `history` messages répartis sur `topics` sujets"""
+    rng = random.Random(42)
+    for user_id in range(1, args.users + 1):
+        if not args.history:
+            continue
+        topic_ids = [database.create_topic(user_id, f"bench{user_id}", " ".join(topic_words(t)),
+                                           created_at=start_date)
+                     for t in range(args.topics)]
+        rows = []
+        step = timedelta(minutes=1)
+        for i in range(args.history):
+            topic_index = i % args.topics
+            rows.append((topic_ids[topic_index], user_id, f"bench{user_id}",
+                         synthetic_question(rng, topic_index), "Réponse " + " ".join(rng.choices(VOCABULARY, k=40)),
+                         start_date + step * i))
+        database.insert_messages(rows)
+    database.round_trips = 0
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(values):
+    return {f"p{p}": round(percentile(values, p) * 1000, 1) for p in (50, 95, 99)}
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="talkwise-bench-")
+    port = free_port()
+    configure_environment(args, port, workdir)
+
+    import bot
+    import ollama_client
+    import vector_index
+    from bench.fake_services import FakeOllama, FakeOpenAI, start_fake_services
+    from bench.fake_database import FakeDatabase
+    from logging_setup import configure_logging
+
+    configure_logging()
+    database = FakeDatabase(latency=args.db_latency)
+    install_stand_ins(database)
+    ollama = FakeOllama(tokens=args.tokens, token_latency=args.token_latency)
+    openai_stub = FakeOpenAI(latency=args.openai_latency)
+    runner = await start_fake_services(port, ollama, openai_stub)
+
+    start_date = datetime.utcnow() - timedelta(days=30)
+    preload(database, args, start_date)
+    await bot.message_writer.start()
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    message_latencies, first_visible, gpt_latencies = [], [], []
+    rng = random.Random(7)
+
+    async def send(user_id, text):
+        async with semaphore:
+            recorder = Recorder()
+            await bot.handle_message(make_update(user_id, text, recorder), SimpleNamespace(args=[]))
+            message_latencies.append(time.perf_counter() - recorder.started)
+            if recorder.first_visible is not None:
+                first_visible.append(recorder.first_visible)
+
+    async def ask_gpt(user_id):
+        async with semaphore:
+            recorder = Recorder()
+            context = SimpleNamespace(args=[start_date.strftime("%Y-%m-%d")])
+            await bot.use_gpt(make_update(user_id, "/useGPT", recorder), context)
+            gpt_latencies.append(time.perf_counter() - recorder.started)
+
+    async def user_session(user_id):
+        for _ in range(args.messages):
+            await send(user_id, synthetic_question(rng, rng.randrange(max(1, args.topics))))
+        for _ in range(args.gpt):
+            await ask_gpt(user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+
+    await bot.message_writer.stop()
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await vector_index.stop()
+    await ollama_client.close_client()
+    await runner.cleanup()
+
+    total_messages = args.users * args.messages
+    return {
+        "scenario": args.scenario,
+        "users": args.users,
+        "messages": total_messages,
+        "gpt_calls": len(gpt_latencies),
+        "duration_s": round(elapsed, 2),
+        "messages_per_s": round(total_messages / elapsed, 2) if elapsed else 0.0,
+        "message_latency_ms": summarize(message_latencies),
+        "first_visible_ms": summarize(first_visible),
+        "use_gpt_latency_ms": summarize(gpt_latencies),
+        "db_round_trips": database.round_trips,
+        "db_round_trips_per_message": round(database.round_trips / total_messages, 2) if total_messages else 0.0,
+        "ollama_requests": ollama.requests,
+        "openai_requests": openai_stub.requests,
+        "memory_growth_mb": round((memory_after - memory_before) / 2**20, 2),
+        "memory_peak_mb": round(memory_peak / 2**20, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def print_report(report):
+    print(f"Scénario {report['scenario']} : {report['users']} utilisateurs, {report['messages']} messages, "
+          f"{report['gpt_calls']} appels /useGPT en {report['duration_s']} s")
+    print(f"  Débit                    : {report['messages_per_s']} messages/s")
+    for key, label in (("message_latency_ms", "Latence par message"), ("first_visible_ms", "Première réponse visible"),
+                       ("use_gpt_latency_ms", "Latence /useGPT")):
+        values = report[key]
+        print(f"  {label:<24} : p50 {values['p50']} ms, p95 {values['p95']} ms, p99 {values['p99']} ms")
+    print(f"  Allers-retours MySQL     : {report['db_round_trips']} ({report['db_round_trips_per_message']} par message)")
+    print(f"  Requêtes Ollama / OpenAI : {report['ollama_requests']} / {report['openai_requests']}")
+    print(f"  Mémoire                  : +{report['memory_growth_mb']} Mo (pic {report['memory_peak_mb']} Mo, "
+          f"RSS max {report['max_rss_mb']} Mo)")
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,75 @@
 import os
-import requests
-import openai
+import logging
+import time
+import asyncio
+import tempfile
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
-from redis_client import save_user_message, get_user_history
+import redis_client
+import ollama_client
+import topic_cache
+import response_cache
+import topic_router
+import vector_index
+import webhook
+import metrics
+import retention
+from logging_setup import configure_logging
+from write_behind import MessageWriter
+from llm_scheduler import scheduler as llm_scheduler, QueueFull
+from streaming import ProgressiveReply, split_message
+from redis_client import save_exchange
+from prompt_builder import build_prompt
+from gpt_analysis import analyze
+from search import search_history, format_results
 from mysql_client import (
-    insert_message, get_history_since, get_or_create_active_topic,
-    get_user_topics, create_new_topic
+    get_or_create_active_topic,
+    get_user_topics, create_new_topic, init_database, run_db
 )
 
+logger = logging.getLogger(__name__)
+
 # Config API
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Nombre de mises à jour Telegram traitées simultanément
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", 64))
+# Réponses Mistral affichées progressivement (désactivable avec OLLAMA_STREAM=0)
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "1") == "1"
+
+# Écriture différée des échanges vers MySQL
+message_writer = MessageWriter()
+
+metrics.track_queue("llm_waiting", lambda: llm_scheduler.depth)
+metrics.track_queue("llm_active", lambda: llm_scheduler.active)
+metrics.track_queue("write_behind", lambda: message_writer.depth)
 
 # --- IA locale : Mistral (Ollama)
-def query_local_llm(prompt):
-    response = requests.post(
-        "http://ollama:11434/api/generate",
-        json={"model": "mistral", "prompt": prompt, "stream": False}
-    )
-    print("Réponse Ollama brute:", response.json())  # Ajout pour debug
-    return response.json()["response"]
+async def query_local_llm(messages):
+    return await ollama_client.chat(messages)
+
+async def resolve_active_topic(user_id, username, message):
+    """Sujet du message : routage sémantique, sinon sujet actif (cache puis MySQL)"""
+    topic = await topic_cache.get_active_topic(user_id)
+    if topic_router.TOPIC_ROUTER_ENABLED:
+        try:
+            routed = await topic_router.route(user_id, username, message, topic)
+        except Exception as router_error:
+            logger.warning(f"Routage sémantique indisponible, sujet actif conservé: {router_error}")
+            routed = None
+        if routed is not None:
+            if routed != topic:
+                await topic_cache.store_active_topic(user_id, *routed)
+            return routed
+    if topic is None:
+        topic = await run_db(get_or_create_active_topic, user_id, username, message)
+        await topic_cache.store_active_topic(user_id, *topic)
+    return topic
+
+def ollama_busy_text():
+    percent = ollama_client.pull_percent()
+    if percent is not None:
+        return f"⏳ Mistral est en cours d'installation ({percent} %), réessaie dans quelques minutes."
+    return "⏳ Mistral est momentanément indisponible, réessaie dans quelques instants."
 
 # --- Commande /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -36,40 +85,124 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Récupère ou crée un sujet de discussion
-        topic_id, topic_title = get_or_create_active_topic(user_id, username, user_message)
-        print(f"Sujet actif: {topic_title} (ID: {topic_id})")
+        with metrics.stage("topic_lookup"):
+            topic_id, topic_title = await resolve_active_topic(user_id, username, user_message)
+        logger.debug(f"Sujet actif: {topic_title} (ID: {topic_id})")
     except Exception as topic_error:
-        print(f"Erreur lors de la récupération/création du sujet: {topic_error}")
+        logger.warning(f"Erreur lors de la récupération/création du sujet: {topic_error}")
         # Continuer sans topic_id
 
+    progressive = None
     try:
-        save_user_message(user_id, f"user: {user_message}")
-    except Exception as redis_error:
-        print(f"Erreur Redis: {redis_error}")
-        # Continuer même si Redis échoue
+        # Contexte : historique récent du sujet dans la limite du budget de tokens
+        with metrics.stage("prompt_build"):
+            messages = await build_prompt(user_id, user_message, topic_id=topic_id)
 
-    try:
-        # Réponse locale via Mistral (Ollama)
-        reply = query_local_llm(user_message)
+        # Question déjà posée dans le même contexte : réponse servie sans Ollama ni file d'attente
+        with metrics.stage("response_cache_lookup"):
+            reply = await response_cache.lookup(user_id, messages, ollama_client.OLLAMA_MODEL)
+        if reply is not None:
+            with metrics.stage("telegram_send"):
+                for part in split_message(reply):
+                    await update.message.reply_text(part)
+            await save_reply(user_id, username, topic_id, user_message, reply)
+            return
+
+        # Ollama hors service ou modèle en cours de téléchargement : réponse immédiate
+        if not ollama_client.is_available():
+            await update.message.reply_text(ollama_busy_text())
+            return
 
         try:
-            save_user_message(user_id, f"bot: {reply}")
-        except Exception as redis_save_error:
-            print(f"Erreur lors de la sauvegarde Redis: {redis_save_error}")
-        
+            job, coalesced = llm_scheduler.submit(user_id, user_message)
+        except QueueFull:
+            await update.message.reply_text("⏳ Mistral est très sollicité, réessaie dans quelques instants.")
+            return
+        if coalesced:
+            # La demande en attente répondra aussi à ce message
+            await update.message.reply_text("📥 Message ajouté à ta demande en attente.")
+            return
         try:
-            # Stocke le message avec le username et le topic_id
-            insert_message(user_id, user_message, reply, username=username, topic_id=topic_id)
-        except Exception as db_error:
-            print(f"Erreur lors de l'insertion en base de données: {db_error}")
-            # Continuer même en cas d'échec de l'enregistrement
+            position = llm_scheduler.position(job)
+            if position:
+                await update.message.reply_text(f"⏳ Tu es n°{position} dans la file d'attente.")
+        except BaseException:
+            # Le job n'entrera jamais dans turn() : sa place doit être rendue
+            llm_scheduler.cancel(job)
+            raise
+
+        queued_at = time.perf_counter()
+        async with llm_scheduler.turn(job):
+            metrics.observe_stage("queue_wait", time.perf_counter() - queued_at)
+            if job.waited or len(job.texts) > 1:
+                # L'historique a pu changer pendant l'attente et d'autres messages ont pu s'ajouter
+                user_message = job.prompt
+                messages = await build_prompt(user_id, user_message, topic_id=topic_id)
+
+            # Réponse locale via Mistral (Ollama)
+            if OLLAMA_STREAM:
+                # Message d'attente édité au fil des morceaux générés
+                progressive = ProgressiveReply(update.message)
+                await progressive.start()
+                started_at = time.perf_counter()
+                first_token = True
+                # Temps passé à éditer le message Telegram (mesuré dans telegram_edit) :
+                # retiré de la durée de génération
+                editing = 0.0
+                try:
+                    async for piece in ollama_client.stream_chat(messages):
+                        if first_token:
+                            metrics.observe_stage("ollama_first_token", time.perf_counter() - started_at)
+                            first_token = False
+                        edit_started = time.perf_counter()
+                        await progressive.append(piece)
+                        editing += time.perf_counter() - edit_started
+                finally:
+                    metrics.observe_stage("ollama_generation", time.perf_counter() - started_at - editing)
+                reply = await progressive.finish()
+            else:
+                with metrics.stage("ollama_generation"):
+                    reply = await query_local_llm(messages)
+                with metrics.stage("telegram_send"):
+                    for part in split_message(reply):
+                        await update.message.reply_text(part)
+
+        await response_cache.store(user_id, messages, ollama_client.OLLAMA_MODEL, reply)
+        await save_reply(user_id, username, topic_id, user_message, reply)
 
-        await update.message.reply_text(reply)
+    except ollama_client.OllamaUnavailable:
+        if progressive is not None:
+            await progressive.fail(ollama_busy_text())
+        else:
+            await update.message.reply_text(ollama_busy_text())
 
     except Exception as e:
         error_msg = str(e)
-        print(f"Erreur Mistral complète: {error_msg}")
-        await update.message.reply_text(f"❌ Erreur Mistral : {error_msg[:200]}{'...' if len(error_msg) > 200 else ''}")
+        logger.exception(f"Erreur Mistral complète: {error_msg}")
+        error_text = f"❌ Erreur Mistral : {error_msg[:200]}{'...' if len(error_msg) > 200 else ''}"
+        if progressive is not None:
+            await progressive.fail(error_text)
+        else:
+            await update.message.reply_text(error_text)
+
+async def save_reply(user_id, username, topic_id, user_message, reply):
+    """Enregistre l'échange dans la mémoire Redis et (en différé) dans MySQL"""
+    try:
+        # Question et réponse enregistrées ensemble dans la mémoire Redis
+        with metrics.stage("redis_save"):
+            await save_exchange(user_id, user_message, reply, topic_id=topic_id)
+    except Exception as redis_save_error:
+        logger.warning(f"Erreur lors de la sauvegarde Redis: {redis_save_error}")
+    
+    try:
+        # Stocke le message avec le username et le topic_id (écriture différée, par lots)
+        await message_writer.enqueue(user_id, user_message, reply, username=username, topic_id=topic_id)
+    except Exception as db_error:
+        logger.warning(f"Erreur lors de l'insertion en base de données: {db_error}")
+        # Continuer même en cas d'échec de l'enregistrement
+
+    # Les échanges déjà écrits en base rejoignent l'index des souvenirs
+    vector_index.schedule_refresh(user_id)
 
 # --- Commande /useGPT [YYYY-MM-DD]
 async def use_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -83,81 +216,25 @@ async def use_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     since_date = args[0]
 
     try:
-        # Récupère l'historique depuis la date spécifiée
-        history = get_history_since(user_id, since_date)
+        # Résumés par sujet (ou historique lu page par page) analysés par ChatGPT
+        reply = await analyze(user_id, since_date)
 
-        if not history:
+        if reply is None:
             await update.message.reply_text("Aucun message trouvé depuis cette date.")
             return
 
-        # Organiser les messages par sujet
-        topics = {}
-        for item in history:
-            # Vérifier si nous avons reçu des enregistrements au nouveau format ou ancien format
-            if len(item) >= 5:
-                user_msg, bot_msg, timestamp, title, topic_id = item
-            else:
-                user_msg, bot_msg, timestamp = item[:3]
-                title = "Conversation sans sujet"
-                topic_id = "default"
-                
-            if topic_id not in topics:
-                topics[topic_id] = {"title": title, "messages": []}
-            topics[topic_id]["messages"].append((user_msg, bot_msg, timestamp))
-        
-        # Si plusieurs sujets, informer ChatGPT du contexte
-        topic_info = ""
-        if len(topics) > 1:
-            topic_info = f"Cette analyse porte sur {len(topics)} sujets différents: "
-            topic_info += ", ".join([f"\"{t['title']}\"" for t in topics.values()])
-            topic_info += ". "
-        
-        messages = []
-        # Ajout d'une instruction système pour guider ChatGPT
-        system_prompt = f"Analyse cette conversation{' organisée par sujets ' if len(topics) > 1 else ' '}"
-        system_prompt += "et réponds directement en validant si tout est correct ou en suggérant des modifications/ajouts. "
-        system_prompt += topic_info
-        system_prompt += "Sois précis et concis dans ton analyse."
-        
-        messages.append({"role": "system", "content": system_prompt})
-        
-        # Ajouter chaque sujet avec ses messages
-        for topic_id, topic_data in topics.items():
-            if len(topics) > 1:  # Si plusieurs sujets, les séparer clairement
-                messages.append({"role": "user", "content": f"=== SUJET: {topic_data['title']} ==="})
-                
-            for user_msg, bot_msg, _ in topic_data["messages"]:
-                messages.append({"role": "user", "content": user_msg})
-                messages.append({"role": "assistant", "content": bot_msg})
-
-        # Appel OpenAI ChatGPT
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=messages
-        )
-
-        reply = response.choices[0].message.content
-        await update.message.reply_text(f"💬 Réponse de ChatGPT (depuis {since_date}) :\n\n{reply}")
+        # Réponse découpée pour respecter la limite de 4096 caractères de Telegram
+        for part in split_message(f"💬 Réponse de ChatGPT (depuis {since_date}) :\n\n{reply}"):
+            await update.message.reply_text(part)
 
     except Exception as e:
         await update.message.reply_text(f"❌ Erreur GPT : {str(e)}")
 
 
-def ensure_mistral_is_ready():
-    try:
-        models = requests.get("http://ollama:11434/api/tags").json()
-        if not any(model["name"] == "mistral" for model in models.get("models", [])):
-            print("🔄 Mistral non présent, téléchargement en cours...")
-            resp = requests.post("http://ollama:11434/api/pull", json={"name": "mistral"})
-            print("✔️  Pull lancé :", resp.status_code)
-    except Exception as e:
-        print("❌ Impossible de vérifier les modèles :", e)
-        
-        
 # --- Commande /topics - Liste les sujets de l'utilisateur
 async def list_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    topics = get_user_topics(user_id)
+    topics = await run_db(get_user_topics, user_id)
 
     if not topics:
         await update.message.reply_text("Vous n'avez pas encore de sujets de discussion.")
@@ -181,18 +258,148 @@ async def new_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     title = " ".join(args)
-    topic_id = create_new_topic(user_id, username, title)
+    topic_id = await run_db(create_new_topic, user_id, username, title)
+    await topic_cache.store_active_topic(user_id, topic_id, title)
     await update.message.reply_text(f"✅ Nouveau sujet créé : \"{title}\"\nVos messages seront maintenant liés à ce sujet.")
 
-# --- Lancement du bot
-if __name__ == '__main__':
-    ensure_mistral_is_ready()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+async def ensure_embed_model():
+    try:
+        await ollama_client.ensure_model(ollama_client.OLLAMA_EMBED_MODEL, load=False)
+    except Exception as e:
+        logger.warning(f"❌ Modèle d'embeddings indisponible : {e}")
+
+async def on_startup(app):
+    await message_writer.start()
+    # Vérifie le modèle, surveille Ollama et garde le modèle chargé, sans bloquer le démarrage
+    app.bot_data["ollama_warmup"] = asyncio.create_task(ollama_client.keep_model_loaded())
+    if topic_router.TOPIC_ROUTER_ENABLED or vector_index.VECTOR_INDEX_ENABLED:
+        # Routage des sujets et rappel des souvenirs embeddent chaque message
+        app.bot_data["embed_pull"] = asyncio.create_task(ensure_embed_model())
+    if topic_router.TOPIC_ROUTER_ENABLED:
+        # Centroïdes enregistrés par lots, hors du traitement des messages
+        app.bot_data["centroid_flush"] = asyncio.create_task(topic_router.flush_periodically())
+    if retention.RETENTION_MONTHS:
+        # Archive les mois sortis de la période de rétention pour garder la table messages petite
+        app.bot_data["retention"] = asyncio.create_task(retention.run_periodically())
+
+async def on_shutdown(app):
+    app.bot_data["ollama_warmup"].cancel()
+    if "retention" in app.bot_data:
+        app.bot_data["retention"].cancel()
+    if "centroid_flush" in app.bot_data:
+        app.bot_data["centroid_flush"].cancel()
+        await topic_router.flush()
+    await message_writer.stop()  # Écrit les derniers messages en attente
+    await vector_index.stop()  # Les mises à jour de l'index utilisent encore le client Ollama
+    await ollama_client.close_client()
+    await redis_client.close()
+
+# --- Commande /search termes [page N] - Recherche dans l'historique
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    args = list(context.args)
+
+    page = 1
+    if len(args) >= 2 and args[-2].lower() == "page" and args[-1].isdigit():
+        page = max(1, int(args[-1]))
+        args = args[:-2]
+
+    if not args:
+        await update.message.reply_text("❗ Utilisation : /search termes [page N]")
+        return
+
+    terms = " ".join(args)
+    try:
+        results, has_more = await search_history(user_id, terms, page)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Erreur de recherche : {str(e)}")
+        return
+
+    if not results:
+        await update.message.reply_text("Aucun message ne correspond à cette recherche.")
+        return
+
+    for part in split_message(format_results(results, terms, page, has_more)):
+        await update.message.reply_text(part)
+
+# --- Commande /cache on|off - Active ou désactive le cache des réponses pour l'utilisateur
+async def cache_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    args = context.args
+
+    if not args or args[0].lower() not in ("on", "off"):
+        state = "désactivé" if await response_cache.is_opted_out(user_id) else "activé"
+        await update.message.reply_text(f"❗ Utilisation : /cache on|off (actuellement : {state})")
+        return
+
+    opted_out = args[0].lower() == "off"
+    await response_cache.set_opt_out(user_id, opted_out)
+    if opted_out:
+        await update.message.reply_text("✅ Cache désactivé : Mistral générera toujours une nouvelle réponse.")
+    else:
+        await update.message.reply_text("✅ Cache activé : les questions déjà posées seront servies plus vite.")
+
+# --- Commande /export - Envoie tout l'historique de l'utilisateur (archives comprises)
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    await update.message.reply_text("📦 Préparation de l'export de ton historique...")
+
+    # Historique écrit au fil de la lecture dans un fichier temporaire, jamais chargé en entier
+    fd, path = tempfile.mkstemp(prefix=f"talkwise-{user_id}-", suffix=".jsonl")
+    os.close(fd)
+    try:
+        count = await run_db(retention.export_history, user_id, path)
+        if not count:
+            await update.message.reply_text("Aucun message à exporter.")
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f, filename=f"talkwise-historique-{user_id}.jsonl",
+                caption=f"📦 {count} messages exportés"
+            )
+    except Exception as e:
+        await update.message.reply_text(f"❌ Erreur d'export : {str(e)}")
+    finally:
+        os.remove(path)
+
+def build_application():
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("useGPT", use_gpt))
     app.add_handler(CommandHandler("topics", list_topics))
     app.add_handler(CommandHandler("newtopic", new_topic))
+    app.add_handler(CommandHandler("cache", cache_setting))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("export", export_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    print("Bot Telegram avec Mistral + OpenAI lancé ✅")
-    app.run_polling()
+    return app
 
+# --- Lancement du bot
+if __name__ == '__main__':
+    # polling (un seul processus), webhook (réception + workers), ingress ou worker (répliques séparées)
+    mode = os.getenv("BOT_MODE", "polling")
+    configure_logging()
+    if mode == "polling":
+        init_database()  # Vérification du schéma une seule fois au démarrage
+        metrics.start_metrics_server()
+        app = build_application()
+        logger.info("Bot Telegram avec Mistral + OpenAI lancé ✅")
+        app.run_polling()
+    elif mode == "webhook":
+        init_database()
+        metrics.start_metrics_server()
+        webhook.run_webhook(TELEGRAM_TOKEN)
+    elif mode == "ingress":
+        metrics.start_metrics_server()
+        asyncio.run(webhook.run_ingress(TELEGRAM_TOKEN))
+    elif mode == "worker":
+        webhook.worker_main(int(os.getenv("WEBHOOK_WORKER_INDEX", 0)))
+    else:
+        raise SystemExit(f"BOT_MODE inconnu : {mode}")
@@ -0,0 +1,357 @@
+import os
+import logging
+import random
+import asyncio
+import openai
+from openai import AsyncOpenAI
+from mysql_client import (
+    get_history_page, get_topics_active_since, get_topic_tail,
+    get_topic_messages_between, update_topic_summary, run_db, HISTORY_PAGE_SIZE
+)
+from prompt_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+GPT_MODEL = os.getenv("GPT_MODEL", "gpt-3.5-turbo-0125")
+# Taille maximale (en tokens estimés) d'une fenêtre d'historique envoyée à ChatGPT
+GPT_WINDOW_TOKENS = int(os.getenv("GPT_WINDOW_TOKENS", 8000))
+GPT_SUMMARY_MAX_TOKENS = int(os.getenv("GPT_SUMMARY_MAX_TOKENS", 500))
+# Analyse à partir des résumés par sujet plutôt que de l'historique complet
+GPT_USE_TOPIC_SUMMARIES = os.getenv("GPT_USE_TOPIC_SUMMARIES", "1") == "1"
+# Nombre d'échanges récents transmis tels quels, en plus du résumé
+GPT_SUMMARY_TAIL = int(os.getenv("GPT_SUMMARY_TAIL", 6))
+# Fenêtres résumées au plus par sujet pendant /useGPT ; le rattrapage d'un résumé
+# en retard se poursuit ensuite en arrière-plan
+GPT_SUMMARY_MAX_WINDOWS = int(os.getenv("GPT_SUMMARY_MAX_WINDOWS", 3))
+# Une analyse par sujet, lancées en parallèle, au lieu d'une seule requête pour tous les sujets
+GPT_PARALLEL_TOPICS = os.getenv("GPT_PARALLEL_TOPICS", "1") == "1"
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", 4))
+GPT_MAX_RETRIES = int(os.getenv("GPT_MAX_RETRIES", 4))
+GPT_TIMEOUT = float(os.getenv("GPT_TIMEOUT", 60))
+
+# Erreurs temporaires : la requête est réessayée avec un délai croissant
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+_client = None
+_semaphore = None
+
+SUMMARY_PROMPT = (
+    "Résume cette portion de conversation entre un utilisateur et l'assistant Mistral. "
+    "Conserve les questions posées, les réponses données, les faits et chiffres importants, "
+    "ainsi que les éventuelles erreurs de l'assistant. Indique les sujets concernés."
+)
+
+async def iter_history(user_id, since_date, page_size=HISTORY_PAGE_SIZE):
+    """Historique depuis une date, lu page par page sans bloquer la boucle"""
+    after = None
+    while True:
+        rows = await run_db(get_history_page, user_id, since_date, after, page_size)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = (rows[-1][3], rows[-1][0])
+
+async def iter_windows(rows, budget=GPT_WINDOW_TOKENS):
+    """Regroupe les lignes en fenêtres qui tiennent dans le budget de tokens"""
+    window = []
+    used = 0
+    async for _, user_msg, bot_msg, timestamp, title, topic_id in rows:
+        user_msg = user_msg or ""
+        bot_msg = bot_msg or ""
+        cost = estimate_tokens(user_msg) + estimate_tokens(bot_msg)
+        if cost > budget:
+            # Échange isolé trop long : tronqué pour tenir seul dans une fenêtre
+            limit = budget * 2
+            user_msg, bot_msg = user_msg[:limit], bot_msg[:limit]
+            cost = estimate_tokens(user_msg) + estimate_tokens(bot_msg)
+        if window and used + cost > budget:
+            yield window
+            window = []
+            used = 0
+        window.append((user_msg, bot_msg, timestamp, title, topic_id))
+        used += cost
+    if window:
+        yield window
+
+def group_by_topic(rows):
+    """Organise les messages par sujet, dans l'ordre d'apparition"""
+    topics = {}
+    for user_msg, bot_msg, timestamp, title, topic_id in rows:
+        if topic_id not in topics:
+            topics[topic_id] = {"title": title, "messages": []}
+        topics[topic_id]["messages"].append((user_msg, bot_msg, timestamp))
+    return topics
+
+def analysis_system_prompt(titles):
+    # Si plusieurs sujets, informer ChatGPT du contexte
+    topic_info = ""
+    if len(titles) > 1:
+        topic_info = f"Cette analyse porte sur {len(titles)} sujets différents: "
+        topic_info += ", ".join([f"\"{title}\"" for title in titles])
+        topic_info += ". "
+
+    system_prompt = f"Analyse cette conversation{' organisée par sujets ' if len(titles) > 1 else ' '}"
+    system_prompt += "et réponds directement en validant si tout est correct ou en suggérant des modifications/ajouts. "
+    system_prompt += topic_info
+    system_prompt += "Sois précis et concis dans ton analyse."
+    return system_prompt
+
+def build_analysis_messages(rows):
+    """Conversation complète, sujet par sujet, précédée de l'instruction d'analyse"""
+    topics = group_by_topic(rows)
+    messages = [{"role": "system", "content": analysis_system_prompt([t["title"] for t in topics.values()])}]
+
+    # Ajouter chaque sujet avec ses messages
+    for topic_data in topics.values():
+        if len(topics) > 1:  # Si plusieurs sujets, les séparer clairement
+            messages.append({"role": "user", "content": f"=== SUJET: {topic_data['title']} ==="})
+        for user_msg, bot_msg, _ in topic_data["messages"]:
+            messages.append({"role": "user", "content": user_msg})
+            messages.append({"role": "assistant", "content": bot_msg})
+    return messages
+
+def render_transcript(rows):
+    """Transcription texte d'une fenêtre, avec les titres de sujets"""
+    lines = []
+    current = None
+    for user_msg, bot_msg, timestamp, title, topic_id in rows:
+        if topic_id != current:
+            lines.append(f"=== SUJET: {title} ===")
+            current = topic_id
+        lines.append(f"Utilisateur : {user_msg}")
+        lines.append(f"Mistral : {bot_msg}")
+    return "\n".join(lines)
+
+def get_client():
+    """Client OpenAI asynchrone partagé (les retries sont gérés par complete())"""
+    global _client, _semaphore
+    if _client is None:
+        _client = AsyncOpenAI(timeout=GPT_TIMEOUT, max_retries=0)
+        _semaphore = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+    return _client
+
+def _retry_delay(error, attempt):
+    # Délai demandé par l'API s'il est fourni, sinon backoff exponentiel avec gigue
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+async def complete(messages, max_tokens=None):
+    """Appel ChatGPT, limité à GPT_MAX_CONCURRENCY requêtes simultanées"""
+    client = get_client()
+    attempt = 0
+    while True:
+        try:
+            async with _semaphore:
+                response = await client.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                )
+            return response.choices[0].message.content
+        except RETRYABLE_ERRORS as e:
+            attempt += 1
+            if attempt > GPT_MAX_RETRIES:
+                raise
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"Erreur temporaire OpenAI (tentative {attempt}/{GPT_MAX_RETRIES}), nouvel essai dans {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+async def summarize(text):
+    return await complete(
+        [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": text}],
+        max_tokens=GPT_SUMMARY_MAX_TOKENS,
+    )
+
+async def analyze(user_id, since_date):
+    """Point d'entrée de /useGPT : résumés par sujet, ou lecture complète de l'historique"""
+    if GPT_USE_TOPIC_SUMMARIES:
+        return await analyze_with_summaries(user_id, since_date)
+    return await analyze_history(user_id, since_date)
+
+async def analyze_history(user_id, since_date):
+    """Analyse ChatGPT de l'historique depuis une date, ou None s'il est vide
+
+    Un historique qui tient dans une fenêtre est envoyé tel quel. Sinon chaque
+    fenêtre est résumée dès qu'elle est complète (map), les résumés sont
+    fusionnés quand ils dépassent eux-mêmes le budget (reduce) et l'analyse
+    finale porte sur ces résumés : mémoire et taille des requêtes restent bornées.
+    """
+    windows = iter_windows(iter_history(user_id, since_date))
+    first = await anext(windows, None)
+    if first is None:
+        return None
+    second = await anext(windows, None)
+    if second is None:
+        return await complete(build_analysis_messages(first))
+
+    titles = {}
+    summaries = []
+
+    async def add_window(window):
+        for _, _, _, title, topic_id in window:
+            titles.setdefault(topic_id, title)
+        summaries.append(await summarize(render_transcript(window)))
+        # Réduction au fil de l'eau : les résumés accumulés restent dans le budget
+        if sum(estimate_tokens(s) for s in summaries) > GPT_WINDOW_TOKENS:
+            merged = await summarize("\n\n".join(summaries))
+            summaries[:] = [merged]
+
+    await add_window(first)
+    await add_window(second)
+    async for window in windows:
+        await add_window(window)
+
+    messages = [
+        {"role": "system", "content": analysis_system_prompt(list(titles.values()))},
+        {"role": "user", "content": "Conversation trop longue pour être transmise en entier, en voici le résumé :\n\n"
+                                    + "\n\n".join(summaries)},
+    ]
+    return await complete(messages)
+
+# --- Résumés incrémentaux par sujet
+
+UPDATE_SUMMARY_PROMPT = (
+    "Tu tiens à jour le résumé d'un sujet de discussion entre un utilisateur et l'assistant Mistral. "
+    "Intègre les nouveaux échanges au résumé existant et renvoie uniquement le résumé mis à jour. "
+    "Conserve les questions posées, les réponses données, les faits et chiffres importants, "
+    "ainsi que les éventuelles erreurs de l'assistant."
+)
+
+async def update_summary(summary, transcript):
+    content = f"Résumé existant :\n{summary or '(aucun)'}\n\nNouveaux échanges :\n{transcript}"
+    return await complete(
+        [{"role": "system", "content": UPDATE_SUMMARY_PROMPT}, {"role": "user", "content": content}],
+        max_tokens=GPT_SUMMARY_MAX_TOKENS,
+    )
+
+async def refresh_topic_summary(topic_id, summary, watermark, before_id=None, since_date=None,
+                                max_windows=None, persist=True, user_id=None):
+    """Intègre au résumé les messages postérieurs au dernier message résumé
+
+    Seuls les messages d'id > watermark (et < before_id, et depuis since_date)
+    sont envoyés à ChatGPT, au plus `max_windows` fenêtres. Avec persist, le
+    résumé et le nouveau watermark sont enregistrés après chaque fenêtre.
+    Retourne (résumé, watermark, tout a été résumé ?).
+    """
+    budget = GPT_WINDOW_TOKENS - estimate_tokens(summary or "")
+    windows = 0
+    while True:
+        rows = await run_db(get_topic_messages_between, topic_id, watermark, before_id,
+                            since_date=since_date, user_id=user_id)
+        if not rows:
+            return summary, watermark, True
+        if max_windows is not None and windows >= max_windows:
+            return summary, watermark, False
+
+        window = []
+        used = 0
+        for message_id, user_msg, bot_msg, _ in rows:
+            cost = estimate_tokens(user_msg or "") + estimate_tokens(bot_msg or "")
+            if window and used + cost > budget:
+                break
+            window.append((message_id, user_msg or "", bot_msg or ""))
+            used += cost
+
+        transcript = "\n".join(f"Utilisateur : {u}\nMistral : {b}" for _, u, b in window)
+        summary = await update_summary(summary, transcript)
+        watermark = window[-1][0]
+        windows += 1
+        if persist:
+            await run_db(update_topic_summary, topic_id, summary, watermark)
+        budget = GPT_WINDOW_TOKENS - estimate_tokens(summary)
+
+# Rattrapages de résumés en cours, par sujet
+_catch_ups = {}
+
+def _schedule_catch_up(topic_id, summary, watermark, before_id):
+    """Termine en arrière-plan un résumé persistant resté en retard"""
+    if topic_id in _catch_ups:
+        return
+
+    async def catch_up():
+        try:
+            await refresh_topic_summary(topic_id, summary, watermark, before_id)
+        except Exception as e:
+            logger.warning(f"Rattrapage du résumé du sujet {topic_id} interrompu : {e}")
+        finally:
+            del _catch_ups[topic_id]
+
+    _catch_ups[topic_id] = asyncio.create_task(catch_up())
+
+async def prepare_topic(user_id, topic, since_date):
+    """Résume les échanges du sujet depuis la date (hors derniers) et retourne ses messages pour ChatGPT
+
+    topic_id None désigne les messages sans sujet de l'utilisateur.
+    """
+    topic_id, title, summary, watermark, whole_topic = topic
+    tail = await run_db(get_topic_tail, topic_id, since_date, GPT_SUMMARY_TAIL, user_id=user_id)
+    # Le résumé couvre ce qui précède les échanges transmis tels quels
+    before_id = tail[0][0] if tail else None
+    if whole_topic:
+        # Tout le sujet est dans la période : le résumé persistant s'applique tel quel
+        summary, watermark, complete = await refresh_topic_summary(
+            topic_id, summary, watermark, before_id, max_windows=GPT_SUMMARY_MAX_WINDOWS
+        )
+        if not complete:
+            _schedule_catch_up(topic_id, summary, watermark, before_id)
+    else:
+        # Le résumé persistant inclut des échanges antérieurs à la date : résumé propre à la période
+        summary, _, complete = await refresh_topic_summary(
+            topic_id, None, 0, before_id, since_date=since_date,
+            max_windows=GPT_SUMMARY_MAX_WINDOWS, persist=False, user_id=user_id
+        )
+
+    header = f"=== SUJET: {title} ==="
+    if summary:
+        partial = "" if complete else " (partiel, les échanges plus récents n'y figurent pas encore)"
+        header += f"\nRésumé des échanges précédents{partial} : {summary}"
+    messages = [{"role": "user", "content": header}]
+    for _, user_msg, bot_msg, _ in tail:
+        messages.append({"role": "user", "content": user_msg})
+        messages.append({"role": "assistant", "content": bot_msg})
+    return messages
+
+async def analyze_topic(title, section):
+    system = {"role": "system", "content": analysis_system_prompt([title])}
+    return await complete([system] + section)
+
+async def analyze_with_summaries(user_id, since_date):
+    """Analyse à partir des résumés de sujets et des derniers échanges de chacun
+
+    Les sujets sont préparés en parallèle. Avec GPT_PARALLEL_TOPICS, chaque
+    sujet est aussi analysé séparément et en parallèle : la durée totale est
+    celle du sujet le plus long et non la somme de tous.
+    """
+    topics = await run_db(get_topics_active_since, user_id, since_date)
+    if not topics:
+        return None
+
+    titles = [title for _, title, _, _, _ in topics]
+    sections = await asyncio.gather(*(prepare_topic(user_id, topic, since_date) for topic in topics))
+
+    if GPT_PARALLEL_TOPICS and len(topics) > 1:
+        results = await asyncio.gather(
+            *(analyze_topic(title, section) for title, section in zip(titles, sections)),
+            return_exceptions=True,
+        )
+        parts = []
+        for title, result in zip(titles, results):
+            if isinstance(result, Exception):
+                result = f"❌ Analyse impossible : {result}"
+            parts.append(f"📌 {title}\n{result}")
+        return "\n\n".join(parts)
+
+    messages = [{"role": "system", "content": analysis_system_prompt(titles)}]
+    for section in sections:
+        messages.extend(section)
+    return await complete(messages)
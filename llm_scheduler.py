@@ -0,0 +1,188 @@
+import os
+import uuid
+import logging
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Générations simultanées autorisées : à aligner sur OLLAMA_NUM_PARALLEL côté Ollama
+LLM_MAX_CONCURRENCY = int(os.getenv("OLLAMA_NUM_PARALLEL", 1))
+# Nombre maximal d'utilisateurs en attente et de messages regroupés par demande
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 100))
+LLM_MAX_COALESCED = int(os.getenv("LLM_MAX_COALESCED", 5))
+# Places partagées entre processus : durée d'un bail (renouvelé pendant la génération)
+# et intervalle entre deux tentatives quand toutes les places sont prises
+LLM_SLOT_LEASE = float(os.getenv("LLM_SLOT_LEASE", 60))
+LLM_SLOT_POLL_INTERVAL = float(os.getenv("LLM_SLOT_POLL_INTERVAL", 0.1))
+
+class QueueFull(Exception):
+    """La file d'attente (globale ou de l'utilisateur) est pleine"""
+
+class Job:
+    """Demande de génération d'un utilisateur ; plusieurs messages peuvent y être regroupés"""
+
+    def __init__(self, user_id, text):
+        self.user_id = user_id
+        self.texts = [text]
+        self.waited = False
+        self._ready = asyncio.get_running_loop().create_future()
+
+    @property
+    def prompt(self):
+        return "\n".join(self.texts)
+
+# Baux horodatés avec l'heure du serveur Redis : les horloges des machines n'interviennent pas
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+    return 1
+end
+return 0
+"""
+_RENEW_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[1]), ARGV[2])
+"""
+
+class GlobalSlots:
+    """Places de génération partagées par tous les processus, via un ZSET Redis de baux
+
+    Un processus arrêté brutalement perd ses places à l'expiration de leur bail.
+    """
+
+    def __init__(self, redis, limit, key="talkwise:llm_slots", lease=LLM_SLOT_LEASE,
+                 poll_interval=LLM_SLOT_POLL_INTERVAL):
+        self.redis = redis
+        self.limit = limit
+        self.key = key
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._acquire = redis.register_script(_ACQUIRE_SCRIPT)
+        self._renew = redis.register_script(_RENEW_SCRIPT)
+
+    @asynccontextmanager
+    async def hold(self):
+        token = uuid.uuid4().hex
+        while not await self._acquire(keys=[self.key], args=[self.limit, self.lease, token]):
+            await asyncio.sleep(self.poll_interval)
+        keeper = asyncio.create_task(self._keep_alive(token))
+        try:
+            yield
+        finally:
+            keeper.cancel()
+            try:
+                await self.redis.zrem(self.key, token)
+            except Exception as e:
+                logger.warning(f"Place de génération non rendue (expirera avec son bail) : {e}")
+
+    async def _keep_alive(self, token):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self._renew(keys=[self.key], args=[self.lease, token])
+            except Exception as e:
+                logger.warning(f"Renouvellement du bail de génération impossible : {e}")
+
+class LLMScheduler:
+    """Limite les appels simultanés à Ollama et sert les utilisateurs à tour de rôle
+
+    Chaque utilisateur a au plus une génération en cours et une demande en
+    attente : les messages envoyés pendant l'attente sont regroupés dans cette
+    demande. Les demandes sont servies dans l'ordre d'arrivée des utilisateurs.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 max_coalesced=LLM_MAX_COALESCED):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_coalesced = max_coalesced
+        self._pending = OrderedDict()   # user_id -> Job en attente
+        self._active_users = set()
+        # Limite commune à plusieurs processus (workers webhook) : GlobalSlots, sinon locale
+        self.global_slots = None
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @property
+    def active(self):
+        return len(self._active_users)
+
+    def submit(self, user_id, text):
+        """Ajoute un message ; retourne (job, regroupé avec une demande en attente ?)"""
+        job = self._pending.get(user_id)
+        if job is not None:
+            if len(job.texts) >= self.max_coalesced:
+                raise QueueFull()
+            job.texts.append(text)
+            return job, True
+
+        if len(self._pending) >= self.max_queue:
+            raise QueueFull()
+        job = Job(user_id, text)
+        self._pending[user_id] = job
+        self._dispatch()
+        return job, False
+
+    def position(self, job):
+        """Rang dans la file (0 si la génération peut commencer tout de suite)"""
+        if job._ready.done():
+            return 0
+        for index, user_id in enumerate(self._pending):
+            if user_id == job.user_id:
+                return index + 1
+        return 0
+
+    @asynccontextmanager
+    async def turn(self, job):
+        """Attend le tour du job puis libère sa place à la fin de la génération"""
+        if not job._ready.done():
+            job.waited = True
+        try:
+            await job._ready
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+        try:
+            if self.global_slots is None:
+                yield job
+            else:
+                async with self.global_slots.hold():
+                    yield job
+        finally:
+            self._release(job)
+
+    def cancel(self, job):
+        """Abandonne un job qui n'entrera pas (ou plus) dans turn() : retiré de la file,
+        ou sa place libérée s'il avait déjà été lancé"""
+        if self._pending.get(job.user_id) is job:
+            del self._pending[job.user_id]
+        elif job._ready.done() and not job._ready.cancelled():
+            self._release(job)
+
+    def _release(self, job):
+        self._active_users.discard(job.user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        for user_id in list(self._pending):
+            if len(self._active_users) >= self.max_concurrency:
+                break
+            if user_id in self._active_users:
+                # Une seule génération à la fois par utilisateur : l'ordre des réponses est conservé
+                continue
+            job = self._pending.pop(user_id)
+            if job._ready.done():
+                # Handler annulé dont turn() n'a pas encore retiré le job : on l'abandonne
+                continue
+            self._active_users.add(user_id)
+            job._ready.set_result(None)
+
+scheduler = LLMScheduler()
@@ -0,0 +1,66 @@
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "talkwise_stage_seconds", "Durée de chaque étape du traitement d'un message",
+    ["stage"], buckets=_LATENCY_BUCKETS,
+)
+OLLAMA_SECONDS = Histogram(
+    "talkwise_ollama_seconds", "Durées rapportées par Ollama (chargement, prompt, génération)",
+    ["phase"], buckets=_LATENCY_BUCKETS,
+)
+OLLAMA_TOKENS = Histogram(
+    "talkwise_ollama_tokens", "Tokens traités par Ollama par requête",
+    ["phase"], buckets=(16, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+MYSQL_RETRIES = Counter("talkwise_mysql_retries_total", "Nouvelles tentatives après une erreur MySQL", ["operation"])
+WRITE_BEHIND_ROWS = Counter("talkwise_write_behind_rows_total", "Messages traités par l'écriture différée", ["outcome"])
+CACHE_REQUESTS = Counter("talkwise_cache_requests_total", "Consultations des caches", ["cache", "result"])
+QUEUE_DEPTH = Gauge("talkwise_queue_depth", "Éléments en attente par file", ["queue"])
+MYSQL_POOL = Gauge("talkwise_mysql_pool", "État du pool de connexions MySQL", ["stat"])
+CIRCUIT_OPEN = Gauge("talkwise_circuit_open", "Disjoncteur ouvert (1) ou fermé (0)", ["service"])
+
+@contextmanager
+def stage(name):
+    """Mesure la durée d'un bloc dans talkwise_stage_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+def observe_ollama(result):
+    """Statistiques du dernier morceau d'une réponse Ollama (durées en nanosecondes)"""
+    for phase, field in (("load", "load_duration"), ("prompt_eval", "prompt_eval_duration"),
+                         ("eval", "eval_duration"), ("total", "total_duration")):
+        if result.get(field):
+            OLLAMA_SECONDS.labels(phase).observe(result[field] / 1e9)
+    for phase, field in (("prompt_eval", "prompt_eval_count"), ("eval", "eval_count")):
+        if result.get(field) is not None:
+            OLLAMA_TOKENS.labels(phase).observe(result[field])
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+def track_queue(name, depth_function):
+    """La profondeur de la file est lue à chaque collecte"""
+    QUEUE_DEPTH.labels(name).set_function(depth_function)
+
+def track_circuit(service, is_open):
+    """L'état du disjoncteur est lu à chaque collecte"""
+    CIRCUIT_OPEN.labels(service).set_function(lambda: 1 if is_open() else 0)
+
+def start_metrics_server(offset=0):
+    """Expose /metrics ; chaque processus worker utilise METRICS_PORT + offset"""
+    if METRICS_ENABLED:
+        start_http_server(METRICS_PORT + offset)
@@ -1,157 +1,466 @@
 import os
+import logging
 import mysql.connector
 import uuid
 from datetime import datetime
 import time
+import threading
+import asyncio
+import functools
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import topic_cache
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Configuration du pool de connexions
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(os.getenv("MYSQL_POOL_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", 30))
+POOL_RECYCLE = float(os.getenv("MYSQL_POOL_RECYCLE", 3600))
+POOL_PING_AFTER = float(os.getenv("MYSQL_POOL_PING_AFTER", 5))
+
+
+def _open_connection():
+    """Ouvre une connexion brute vers MySQL"""
+    return mysql.connector.connect(
+        host=os.getenv("MYSQL_HOST"),
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DB"),
+        connection_timeout=20,  # Augmente le timeout de connexion
+        autocommit=True,        # Auto-commit pour éviter les transactions en attente
+    )
+
+
+class PooledConnection:
+    """Connexion empruntée au pool : close() la rend au pool au lieu de la fermer"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn)
+
+    def invalidate(self):
+        """Ferme réellement la connexion (à utiliser après une erreur réseau)"""
+        if not self._released:
+            self._released = True
+            self._pool.discard(self._conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __del__(self):
+        # Filet de sécurité : une connexion oubliée ne doit pas épuiser le pool
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Pool borné de connexions MySQL avec débordement et recyclage"""
+
+    def __init__(self, size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, timeout=POOL_TIMEOUT,
+                 recycle=POOL_RECYCLE, ping_after=POOL_PING_AFTER):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = deque()       # (connexion, créée_le, rendue_le)
+        self._created_at = {}      # id(connexion) -> date de création
+        self._open = 0             # connexions ouvertes (au repos + empruntées)
+        self._cond = threading.Condition()
+        self.stats = {"checkouts": 0, "waits": 0, "misses": 0, "recycled": 0, "invalidated": 0, "overflow": 0}
+
+    def _check(self, conn, created_at, released_at):
+        """Raison de ne pas réutiliser la connexion ("recycled", "invalidated") ou None
+
+        Appelée hors verrou : un ping sur une connexion à moitié fermée peut bloquer.
+        """
+        now = time.monotonic()
+        if self.recycle and now - created_at > self.recycle:
+            return "recycled"
+        if now - released_at < self.ping_after:
+            # Utilisée très récemment : pas besoin de la tester
+            return None
+        try:
+            conn.ping(reconnect=False)
+            return None
+        except mysql.connector.Error:
+            return "invalidated"
+
+    def _close_quietly(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Emprunte une connexion, en attend une ou en ouvre une nouvelle si possible"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self.stats["checkouts"] += 1
+        waited = False
+        while True:
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, created_at, released_at = self._idle.pop()
+                        break
+                    if self._open < self.size + self.max_overflow:
+                        self._open += 1
+                        self.stats["misses"] += 1
+                        if self._open > self.size:
+                            self.stats["overflow"] += 1
+                        conn = None
+                        break
+                    if not waited:
+                        self.stats["waits"] += 1
+                        waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise mysql.connector.errors.PoolError("Pool MySQL épuisé (délai d'attente dépassé)")
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                break
+            # Vérification hors verrou : les autres emprunts ne l'attendent pas
+            reason = self._check(conn, created_at, released_at)
+            if reason is None:
+                return PooledConnection(self, conn)
+            with self._cond:
+                self._open -= 1
+                self.stats[reason] += 1
+                self._created_at.pop(id(conn), None)
+                self._cond.notify()
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        # Ouverture hors verrou : le handshake ne bloque pas les autres threads
+        try:
+            conn = _open_connection()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Rend une connexion au pool (les connexions en débordement sont fermées)"""
+        with self._cond:
+            if len(self._idle) >= self.size:
+                self._open -= 1
+                self._close_quietly(conn)
+            else:
+                created_at = self._created_at.get(id(conn), time.monotonic())
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """Retire définitivement une connexion du pool"""
+        with self._cond:
+            self._open -= 1
+            self.stats["invalidated"] += 1
+            self._close_quietly(conn)
+            self._cond.notify()
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, open=self._open, idle=len(self._idle))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Retourne le pool partagé (créé à la première utilisation)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_pool_stats():
+    """Statistiques du pool : emprunts, attentes, connexions ouvertes..."""
+    return get_pool().get_stats()
+
+for _stat in ("checkouts", "waits", "misses", "recycled", "invalidated", "overflow", "open", "idle"):
+    metrics.MYSQL_POOL.labels(_stat).set_function(lambda stat=_stat: get_pool_stats()[stat])
+
 
 def get_connection(max_retries=3):
-    """Fonction utilitaire pour obtenir une connexion à la base de données avec retry"""
+    """Fonction utilitaire pour emprunter une connexion au pool avec retry"""
     retries = 0
     last_error = None
     
     while retries < max_retries:
         try:
-            conn = mysql.connector.connect(
-                host=os.getenv("MYSQL_HOST"),
-                user=os.getenv("MYSQL_USER"),
-                password=os.getenv("MYSQL_PASSWORD"),
-                database=os.getenv("MYSQL_DB"),
-                connection_timeout=20,  # Augmente le timeout de connexion
-                autocommit=True,        # Auto-commit pour éviter les transactions en attente
-            )
-            
-            # Teste si la connexion est active
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
-            cursor.close()
-            
-            return conn
+            return get_pool().acquire()
+        except mysql.connector.errors.PoolError:
+            raise
         except mysql.connector.Error as err:
             last_error = err
-            print(f"Erreur de connexion MySQL (tentative {retries+1}/{max_retries}): {err}")
+            logger.warning(f"Erreur de connexion MySQL (tentative {retries+1}/{max_retries}): {err}")
+            metrics.MYSQL_RETRIES.labels("connect").inc()
             retries += 1
             time.sleep(1)  # Attends 1 seconde avant de réessayer
     
     # Si on arrive ici, toutes les tentatives ont échoué
     raise last_error  # Remonte la dernière erreur
 
-def init_database():
-    """Initialise les tables de la base de données"""
-    max_retries = 3
-    retries = 0
-    
-    while retries < max_retries:
+# Exécuteur borné pour appeler ce module depuis les handlers asynchrones
+DB_EXECUTOR_WORKERS = int(os.getenv("MYSQL_EXECUTOR_WORKERS", POOL_SIZE + POOL_MAX_OVERFLOW))
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mysql")
+
+async def run_db(func, *args, **kwargs):
+    """Exécute une fonction bloquante de ce module sans bloquer la boucle asyncio"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+# --- Schéma et migrations
+
+def _column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+def _index_exists(cursor, table, index):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+    """, (table, index))
+    return cursor.fetchone() is not None
+
+def _migration_create_tables(cursor):
+    # Création de la table des sujets de discussion
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS topics (
+            topic_id VARCHAR(36) PRIMARY KEY,
+            user_id BIGINT,
+            username VARCHAR(255),
+            title VARCHAR(255),
+            created_at DATETIME
+        )
+    """)
+    # Création de la table des messages - sans contrainte de foreign key pour plus de flexibilité
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            topic_id VARCHAR(36),
+            user_id BIGINT,
+            username VARCHAR(255),
+            message_user TEXT,
+            message_bot TEXT,
+            timestamp DATETIME
+        )
+    """)
+
+def _migration_message_columns(cursor):
+    # Les anciennes bases n'avaient pas ces colonnes sur messages
+    if not _column_exists(cursor, "messages", "topic_id"):
+        logger.info("Ajout de la colonne topic_id à la table messages...")
+        cursor.execute("ALTER TABLE messages ADD COLUMN topic_id VARCHAR(36)")
+    if not _column_exists(cursor, "messages", "username"):
+        logger.info("Ajout de la colonne username à la table messages...")
+        cursor.execute("ALTER TABLE messages ADD COLUMN username VARCHAR(255)")
+
+def _migration_lookup_indexes(cursor):
+    # Index composites pour les requêtes par utilisateur/sujet triées par date
+    indexes = [
+        ("topics", "idx_topics_user_created", "user_id, created_at"),
+        ("messages", "idx_messages_user_timestamp", "user_id, timestamp"),
+        ("messages", "idx_messages_topic_timestamp", "topic_id, timestamp"),
+    ]
+    for table, index, columns in indexes:
+        if not _index_exists(cursor, table, index):
+            cursor.execute(f"CREATE INDEX {index} ON {table} ({columns})")
+
+def _migration_topic_summaries(cursor):
+    # Résumé glissant par sujet et identifiant du dernier message résumé
+    if not _column_exists(cursor, "topics", "summary"):
+        cursor.execute("""
+            ALTER TABLE topics
+                ADD COLUMN summary TEXT,
+                ADD COLUMN summary_message_id INT NOT NULL DEFAULT 0,
+                ADD COLUMN summary_updated_at DATETIME
+        """)
+    # Lecture des messages d'un sujet au-delà du dernier résumé
+    if not _index_exists(cursor, "messages", "idx_messages_topic_id"):
+        cursor.execute("CREATE INDEX idx_messages_topic_id ON messages (topic_id, id)")
+
+def _migration_fulltext_index(cursor):
+    # Recherche plein texte sur les questions et les réponses (/search)
+    if not _index_exists(cursor, "messages", "ft_messages_text"):
+        cursor.execute("ALTER TABLE messages ADD FULLTEXT INDEX ft_messages_text (message_user, message_bot)")
+
+def _migration_topic_centroids(cursor):
+    # Vecteur moyen (float32) des messages de chaque sujet pour le routage sémantique
+    if not _column_exists(cursor, "topics", "centroid"):
+        cursor.execute("""
+            ALTER TABLE topics
+                ADD COLUMN centroid BLOB,
+                ADD COLUMN centroid_count INT NOT NULL DEFAULT 0
+        """)
+
+def _migration_user_id_index(cursor):
+    # Parcours incrémental des messages d'un utilisateur par id (index vectoriel)
+    if not _index_exists(cursor, "messages", "idx_messages_user_id"):
+        cursor.execute("CREATE INDEX idx_messages_user_id ON messages (user_id, id)")
+
+# Migrations ordonnées : (version, description, fonction appliquée avec un curseur)
+MIGRATIONS = [
+    (1, "tables topics et messages", _migration_create_tables),
+    (2, "colonnes topic_id et username sur messages", _migration_message_columns),
+    (3, "index composites topics/messages", _migration_lookup_indexes),
+    (4, "résumés incrémentaux par sujet", _migration_topic_summaries),
+    (5, "index FULLTEXT sur les messages", _migration_fulltext_index),
+    (6, "centroïdes d'embeddings par sujet", _migration_topic_centroids),
+    (7, "index messages(user_id, id)", _migration_user_id_index),
+]
+
+SCHEMA_LOCK_NAME = "talkwise_schema_migration"
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def get_schema_version(cursor):
+    """Retourne la dernière version de schéma appliquée (0 si aucune)"""
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    row = cursor.fetchone()
+    return row[0] or 0
+
+def migrate():
+    """Applique les migrations manquantes, dans l'ordre"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(255),
+                applied_at DATETIME
+            )
+        """)
+
+        # Verrou nommé : plusieurs instances du bot ne migrent pas en même temps
+        cursor.execute("SELECT GET_LOCK(%s, 60)", (SCHEMA_LOCK_NAME,))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Impossible d'obtenir le verrou de migration du schéma")
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            
-            # Création de la table des sujets de discussion
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS topics (
-                    topic_id VARCHAR(36) PRIMARY KEY,
-                    user_id BIGINT,
-                    username VARCHAR(255),
-                    title VARCHAR(255),
-                    created_at DATETIME
-                )
-            """)
-            conn.commit()
-            
-            # Vérifie si la table messages existe déjà
-            cursor.execute("SHOW TABLES LIKE 'messages'")
-            table_exists = cursor.fetchone()
-            
-            if table_exists:
-                # La table existe, vérifions si les colonnes topic_id et username existent
-                try:
-                    cursor.execute("SHOW COLUMNS FROM messages LIKE 'topic_id'")
-                    topic_id_exists = cursor.fetchone()
-                    
-                    cursor.execute("SHOW COLUMNS FROM messages LIKE 'username'")
-                    username_exists = cursor.fetchone()
-                    
-                    # Ajout des colonnes si elles n'existent pas
-                    if not topic_id_exists:
-                        print("Ajout de la colonne topic_id à la table messages...")
-                        cursor.execute("ALTER TABLE messages ADD COLUMN topic_id VARCHAR(36)")
-                        conn.commit()
-                    
-                    if not username_exists:
-                        print("Ajout de la colonne username à la table messages...")
-                        cursor.execute("ALTER TABLE messages ADD COLUMN username VARCHAR(255)")
-                        conn.commit()
-                except Exception as column_error:
-                    print(f"Erreur lors de la vérification/ajout des colonnes: {column_error}")
-            else:
-                # Création de la table des messages - sans contrainte de foreign key pour plus de flexibilité
+            current = get_schema_version(cursor)
+            for version, description, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info(f"Migration du schéma vers la version {version} : {description}")
+                apply(cursor)
                 cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        topic_id VARCHAR(36),
-                        user_id BIGINT,
-                        username VARCHAR(255),
-                        message_user TEXT,
-                        message_bot TEXT,
-                        timestamp DATETIME
-                    )
-                """)
+                    INSERT INTO schema_version (version, description, applied_at)
+                    VALUES (%s, %s, %s)
+                """, (version, description, datetime.utcnow()))
                 conn.commit()
-            
-            # Fermeture de la connexion
-            cursor.close()
-            conn.close()
-            print("Initialisation de la base de données réussie")
+                current = version
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (SCHEMA_LOCK_NAME,))
+            cursor.fetchone()
+        cursor.close()
+        return current
+    finally:
+        conn.close()
+
+def init_database():
+    """Vérifie le schéma une seule fois par processus et applique les migrations"""
+    global _schema_ready
+    if _schema_ready:
+        return
+
+    with _schema_lock:
+        if _schema_ready:
             return
-            
-        except mysql.connector.errors.OperationalError as e:
-            print(f"Erreur de connexion MySQL lors de l'initialisation (tentative {retries+1}/{max_retries}): {e}")
-            retries += 1
-            time.sleep(2)  # Attente plus longue pour l'initialisation
-            
-        except Exception as e:
-            print(f"Erreur inattendue lors de l'initialisation de la base de données: {e}")
-            raise
-    
-    print("❌ Impossible d'initialiser la base de données après plusieurs tentatives")
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+        max_retries = 3
+        retries = 0
+        
+        while retries < max_retries:
+            try:
+                version = migrate()
+                _schema_ready = True
+                logger.info(f"Initialisation de la base de données réussie (schéma v{version})")
+                return
+                
+            except mysql.connector.errors.OperationalError as e:
+                logger.warning(f"Erreur de connexion MySQL lors de l'initialisation (tentative {retries+1}/{max_retries}): {e}")
+                metrics.MYSQL_RETRIES.labels("init").inc()
+                retries += 1
+                time.sleep(2)  # Attente plus longue pour l'initialisation
+                
+            except Exception as e:
+                logger.error(f"Erreur inattendue lors de l'initialisation de la base de données: {e}")
+                raise
+        
+        logger.error("❌ Impossible d'initialiser la base de données après plusieurs tentatives")
 
 def create_topic(user_id, username, title):
     """Crée un nouveau sujet de discussion et retourne son ID"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    topic_id = str(uuid.uuid4())
-    
-    cursor.execute("""
-        INSERT INTO topics (topic_id, user_id, username, title, created_at)
-        VALUES (%s, %s, %s, %s, %s)
-    """, (topic_id, user_id, username, title, datetime.utcnow()))
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        
+        topic_id = str(uuid.uuid4())
+        
+        cursor.execute("""
+            INSERT INTO topics (topic_id, user_id, username, title, created_at)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (topic_id, user_id, username, title, datetime.utcnow()))
+        
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
     
+    # Le nouveau sujet devient le sujet actif
+    topic_cache.remember(user_id, topic_id, title)
     return topic_id
 
 def get_or_create_active_topic(user_id, username, message_content):
     """Obtient le sujet actif pour un utilisateur ou en crée un nouveau"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Récupérer le dernier sujet de l'utilisateur
-    cursor.execute("""
-        SELECT topic_id, title
-        FROM topics
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-        LIMIT 1
-    """, (user_id,))
-    
-    result = cursor.fetchone()
+    try:
+        cursor = conn.cursor()
+        
+        # Récupérer le dernier sujet de l'utilisateur
+        cursor.execute("""
+            SELECT topic_id, title
+            FROM topics
+            WHERE user_id = %s
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, (user_id,))
+        
+        result = cursor.fetchone()
+        cursor.close()
+    finally:
+        # Rendre la connexion avant d'éventuellement en emprunter une autre
+        conn.close()
     
     if result:
         # Sujet existant trouvé
@@ -161,16 +470,24 @@ def get_or_create_active_topic(user_id, username, message_content):
         title = message_content[:50] + "..." if len(message_content) > 50 else message_content
         topic_id = create_topic(user_id, username, title)
     
-    cursor.close()
-    conn.close()
-    
     return topic_id, title
 
+def _insert_minimal(user_id, user_message, bot_reply):
+    """Insertion de secours avec uniquement les colonnes obligatoires"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO messages (user_id, message_user, message_bot, timestamp)
+            VALUES (%s, %s, %s, %s)
+        """, (user_id, user_message, bot_reply, datetime.utcnow()))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
 def insert_message(user_id, user_message, bot_reply, username=None, topic_id=None):
     """Insère un message dans la base de données"""
-    # Assure-toi que les tables existent avec les colonnes requises
-    init_database()
-    
     # Si aucun topic_id n'est fourni, en obtenir ou en créer un
     if not topic_id:
         topic_id, _ = get_or_create_active_topic(user_id, username or "Unknown", user_message)
@@ -179,6 +496,7 @@ def insert_message(user_id, user_message, bot_reply, username=None, topic_id=Non
     retries = 0
     
     while retries < max_retries:
+        conn = None
         try:
             conn = get_connection()
             cursor = conn.cursor()
@@ -189,56 +507,64 @@ def insert_message(user_id, user_message, bot_reply, username=None, topic_id=Non
                 VALUES (%s, %s, %s, %s, %s, %s)
             """, (topic_id, user_id, username or "Unknown", user_message, bot_reply, datetime.utcnow()))
             
-            # Commit et fermeture de la connexion
             conn.commit()
             cursor.close()
             conn.close()
             return  # Sortie en cas de succès
             
         except mysql.connector.errors.OperationalError as e:
-            # Problèmes de connexion
-            print(f"Erreur de connexion MySQL lors de l'insertion (tentative {retries+1}/{max_retries}): {e}")
+            # Problèmes de connexion : la connexion n'est pas rendue au pool
+            if conn is not None:
+                conn.invalidate()
+            logger.warning(f"Erreur de connexion MySQL lors de l'insertion (tentative {retries+1}/{max_retries}): {e}")
+            metrics.MYSQL_RETRIES.labels("insert").inc()
             retries += 1
             if retries >= max_retries:
                 # Dernière tentative: essayer sans les colonnes optionnelles
                 try:
-                    conn = get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO messages (user_id, message_user, message_bot, timestamp)
-                        VALUES (%s, %s, %s, %s)
-                    """, (user_id, user_message, bot_reply, datetime.utcnow()))
-                    conn.commit()
-                    cursor.close()
-                    conn.close()
+                    _insert_minimal(user_id, user_message, bot_reply)
                     return
                 except Exception as fallback_error:
-                    print(f"Échec de l'insertion simplifiée: {fallback_error}")
+                    logger.error(f"Échec de l'insertion simplifiée: {fallback_error}")
                     raise
             time.sleep(1)  # Attendre avant de réessayer
             
         except Exception as e:
-            print(f"Erreur lors de l'insertion du message: {e}")
+            if conn is not None:
+                conn.close()
+            logger.warning(f"Erreur lors de l'insertion du message: {e}")
             # Fallback: insertion avec uniquement les colonnes obligatoires
             try:
-                conn = get_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO messages (user_id, message_user, message_bot, timestamp)
-                    VALUES (%s, %s, %s, %s)
-                """, (user_id, user_message, bot_reply, datetime.utcnow()))
-                conn.commit()
-                cursor.close()
-                conn.close()
+                _insert_minimal(user_id, user_message, bot_reply)
                 return
             except Exception as fallback_error:
-                print(f"Échec de l'insertion simplifiée: {fallback_error}")
+                logger.error(f"Échec de l'insertion simplifiée: {fallback_error}")
                 raise
-
-    conn.commit()
-    cursor.close()
-    conn.close()
     
+def insert_messages(rows):
+    """Insère plusieurs messages en une seule requête multi-lignes
+
+    rows : tuples (topic_id, user_id, username, message_user, message_bot, timestamp)
+    """
+    if not rows:
+        return 0
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        # executemany regroupe les lignes en un seul INSERT ... VALUES (...), (...)
+        cursor.executemany("""
+            INSERT INTO messages (topic_id, user_id, username, message_user, message_bot, timestamp)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, rows)
+        conn.commit()
+        cursor.close()
+    except mysql.connector.errors.OperationalError:
+        conn.invalidate()
+        raise
+    finally:
+        conn.close()
+    return len(rows)
+
 def get_history_since(user_id, since_date: str):
     """Récupère l'historique des messages depuis une date spécifiée"""
     max_retries = 3
@@ -246,6 +572,7 @@ def get_history_since(user_id, since_date: str):
     last_error = None
     
     while retries < max_retries:
+        conn = None
         try:
             conn = get_connection()
             cursor = conn.cursor()
@@ -273,8 +600,10 @@ def get_history_since(user_id, since_date: str):
                 conn.close()
                 return result
                 
+            except mysql.connector.errors.OperationalError:
+                raise
             except Exception as e:
-                print(f"Erreur lors de la récupération complète, tentative simplifiée: {e}")
+                logger.warning(f"Erreur lors de la récupération complète, tentative simplifiée: {e}")
                 # Fallback: récupération des messages sans jointure
                 cursor.execute("""
                     SELECT message_user, message_bot, timestamp
@@ -292,57 +621,379 @@ def get_history_since(user_id, since_date: str):
                 return result
                 
         except mysql.connector.errors.OperationalError as e:
+            if conn is not None:
+                conn.invalidate()
             last_error = e
-            print(f"Erreur de connexion MySQL lors de la récupération (tentative {retries+1}/{max_retries}): {e}")
+            logger.warning(f"Erreur de connexion MySQL lors de la récupération (tentative {retries+1}/{max_retries}): {e}")
+            metrics.MYSQL_RETRIES.labels("history").inc()
             retries += 1
             time.sleep(1)  # Attendre avant de réessayer
             
         except Exception as e:
-            print(f"Erreur inattendue: {e}")
+            if conn is not None:
+                conn.close()
+            logger.error(f"Erreur inattendue: {e}")
             raise
     
     # Si nous arrivons ici, toutes les tentatives ont échoué
     raise last_error
 
+HISTORY_PAGE_SIZE = int(os.getenv("MYSQL_HISTORY_PAGE_SIZE", 500))
+
+def get_history_page(user_id, since_date, after=None, limit=HISTORY_PAGE_SIZE):
+    """Une page d'historique triée par (timestamp, id), à partir de la clé `after`
+
+    Retourne des lignes (id, message_user, message_bot, timestamp, title, topic_id).
+    La page suivante se demande avec after=(timestamp, id) de la dernière ligne :
+    pas d'OFFSET, l'index (user_id, timestamp) suffit quelle que soit la page.
+    """
+    after_ts, after_id = after if after else (since_date, 0)
+    conn = get_connection()
+    try:
+        # Curseur non bufferisé : les lignes sont lues au fil de l'eau depuis le serveur
+        cursor = conn.cursor(buffered=False)
+        cursor.execute("""
+            SELECT m.id, m.message_user, m.message_bot, m.timestamp,
+                   IFNULL(t.title, 'Conversation sans sujet') as title,
+                   IFNULL(m.topic_id, 'default') as topic_id
+            FROM messages m
+            LEFT JOIN topics t ON m.topic_id = t.topic_id
+            WHERE m.user_id = %s AND m.timestamp >= %s
+              AND (m.timestamp > %s OR (m.timestamp = %s AND m.id > %s))
+            ORDER BY m.timestamp ASC, m.id ASC
+            LIMIT %s
+        """, (user_id, since_date, after_ts, after_ts, after_id, limit))
+        rows = []
+        while True:
+            chunk = cursor.fetchmany(100)
+            if not chunk:
+                break
+            rows.extend(chunk)
+        cursor.close()
+    except mysql.connector.errors.OperationalError:
+        conn.invalidate()
+        raise
+    finally:
+        conn.close()
+    return rows
+
+def iter_history_since(user_id, since_date, page_size=HISTORY_PAGE_SIZE):
+    """Parcourt l'historique depuis une date, page par page (une connexion par page)"""
+    after = None
+    while True:
+        rows = get_history_page(user_id, since_date, after, page_size)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = (rows[-1][3], rows[-1][0])
+
 def get_user_topics(user_id):
     """Récupère tous les sujets d'un utilisateur"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT topic_id, title, created_at
-        FROM topics
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-    """, (user_id,))
-    
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT topic_id, title, created_at
+            FROM topics
+            WHERE user_id = %s
+            ORDER BY created_at DESC
+        """, (user_id,))
+        
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
     return result
 
-def get_messages_by_topic(topic_id):
-    """Récupère tous les messages d'un sujet spécifique"""
+def get_messages_by_topic(topic_id, limit=None):
+    """Récupère les messages d'un sujet spécifique (les `limit` plus récents si précisé)"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT message_user, message_bot, timestamp, username
-        FROM messages
-        WHERE topic_id = %s
-        ORDER BY timestamp ASC
-    """, (topic_id,))
-    
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        
+        if limit is None:
+            cursor.execute("""
+                SELECT message_user, message_bot, timestamp, username
+                FROM messages
+                WHERE topic_id = %s
+                ORDER BY timestamp ASC
+            """, (topic_id,))
+            result = cursor.fetchall()
+        else:
+            cursor.execute("""
+                SELECT message_user, message_bot, timestamp, username
+                FROM messages
+                WHERE topic_id = %s
+                ORDER BY timestamp DESC
+                LIMIT %s
+            """, (topic_id, limit))
+            result = cursor.fetchall()[::-1]
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def get_topics_active_since(user_id, since_date):
+    """Sujets ayant des messages depuis une date
+
+    Retourne (topic_id, title, summary, summary_message_id, whole_topic) ; whole_topic
+    vaut 1 si tous les messages du sujet sont postérieurs à la date. Les messages
+    sans sujet forment une dernière ligne de topic_id None.
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT t.topic_id, t.title, t.summary, t.summary_message_id,
+                   (SELECT MIN(m.timestamp) FROM messages m WHERE m.topic_id = t.topic_id) >= %s
+            FROM topics t
+            WHERE t.user_id = %s
+              AND EXISTS (SELECT 1 FROM messages m WHERE m.topic_id = t.topic_id AND m.timestamp >= %s)
+            ORDER BY t.created_at ASC
+        """, (since_date, user_id, since_date))
+        result = cursor.fetchall()
+        # Messages sans sujet (antérieurs aux sujets, ou sujet introuvable à l'écriture) :
+        # regroupés dans un pseudo-sujet, jamais résumé de façon persistante
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM messages
+                           WHERE user_id = %s AND topic_id IS NULL AND timestamp >= %s)
+        """, (user_id, since_date))
+        if cursor.fetchone()[0]:
+            result.append((None, "Conversation sans sujet", None, 0, 0))
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def _topic_condition(topic_id, user_id):
+    """Filtre SQL d'un sujet ; topic_id None : messages sans sujet de l'utilisateur"""
+    if topic_id is None:
+        return "user_id = %s AND topic_id IS NULL", (user_id,)
+    return "topic_id = %s", (topic_id,)
+
+def get_topic_tail(topic_id, since_date, limit, user_id=None):
+    """Les `limit` derniers échanges d'un sujet depuis une date : (id, message_user, message_bot, timestamp)"""
+    condition, params = _topic_condition(topic_id, user_id)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, message_user, message_bot, timestamp
+            FROM messages
+            WHERE {condition} AND timestamp >= %s
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        """, (*params, since_date, limit))
+        result = cursor.fetchall()[::-1]
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def get_topic_messages_between(topic_id, after_id, before_id=None, limit=HISTORY_PAGE_SIZE, since_date=None,
+                               user_id=None):
+    """Messages d'un sujet d'identifiant dans ]after_id, before_id[ (et depuis since_date), par id croissant"""
+    condition, params = _topic_condition(topic_id, user_id)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, message_user, message_bot, timestamp
+            FROM messages
+            WHERE {condition} AND id > %s AND id < %s AND timestamp >= %s
+            ORDER BY id ASC
+            LIMIT %s
+        """, (*params, after_id, before_id if before_id is not None else 2**31 - 1,
+              since_date or "1970-01-01", limit))
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def update_topic_summary(topic_id, summary, last_message_id):
+    """Enregistre un résumé s'il couvre plus de messages que celui en base"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE topics
+            SET summary = %s, summary_message_id = %s, summary_updated_at = %s
+            WHERE topic_id = %s AND summary_message_id < %s
+        """, (summary, last_message_id, datetime.utcnow(), topic_id, last_message_id))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+def search_messages(user_id, terms, limit=10, offset=0):
+    """Recherche plein texte dans l'historique d'un utilisateur, par pertinence
+
+    Retourne des lignes (id, message_user, message_bot, timestamp, title, score).
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT m.id, m.message_user, m.message_bot, m.timestamp,
+                   IFNULL(t.title, 'Conversation sans sujet') as title,
+                   MATCH(m.message_user, m.message_bot) AGAINST (%s IN NATURAL LANGUAGE MODE) as score
+            FROM messages m
+            LEFT JOIN topics t ON m.topic_id = t.topic_id
+            WHERE MATCH(m.message_user, m.message_bot) AGAINST (%s IN NATURAL LANGUAGE MODE)
+              AND m.user_id = %s
+            ORDER BY score DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        """, (terms, terms, user_id, limit, offset))
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def get_topic_centroids(user_id):
+    """Sujets d'un utilisateur avec leur centroïde : (topic_id, title, centroid, centroid_count)"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT topic_id, title, centroid, centroid_count
+            FROM topics
+            WHERE user_id = %s
+            ORDER BY created_at ASC
+        """, (user_id,))
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
     return result
 
+def update_topic_centroids(rows):
+    """Enregistre des centroïdes en une transaction
+
+    rows : tuples (topic_id, centroïde en octets float32, nombre de messages résumés)
+    """
+    if not rows:
+        return
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE topics SET centroid = %s, centroid_count = %s WHERE topic_id = %s
+        """, [(centroid, count, topic_id) for topic_id, centroid, count in rows])
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+def get_user_messages_after(user_id, after_id, limit=HISTORY_PAGE_SIZE):
+    """Messages d'un utilisateur d'id > after_id : (id, message_user, message_bot)"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, message_user, message_bot
+            FROM messages
+            WHERE user_id = %s AND id > %s
+            ORDER BY id ASC
+            LIMIT %s
+        """, (user_id, after_id, limit))
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def get_messages_by_ids(user_id, message_ids):
+    """Messages d'un utilisateur par identifiants : {id: (message_user, message_bot, timestamp)}"""
+    if not message_ids:
+        return {}
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        cursor.execute(f"""
+            SELECT id, message_user, message_bot, timestamp
+            FROM messages
+            WHERE user_id = %s AND id IN ({placeholders})
+        """, (user_id, *message_ids))
+        result = {row[0]: row[1:] for row in cursor.fetchall()}
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def get_messages_before(cutoff, limit=HISTORY_PAGE_SIZE):
+    """Plus anciens messages antérieurs à `cutoff`, par id croissant
+
+    Retourne des lignes (id, user_id, username, topic_id, message_user, message_bot, timestamp).
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, user_id, username, topic_id, message_user, message_bot, timestamp
+            FROM messages
+            WHERE timestamp < %s
+            ORDER BY id ASC
+            LIMIT %s
+        """, (cutoff, limit))
+        result = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+def delete_messages(message_ids):
+    """Supprime des messages par identifiants ; retourne le nombre de lignes supprimées"""
+    if not message_ids:
+        return 0
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        cursor.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", tuple(message_ids))
+        deleted = cursor.rowcount
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    return deleted
+
+def get_first_message_id(user_id):
+    """Plus petit identifiant de message encore en base pour l'utilisateur (None si aucun)"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(id) FROM messages WHERE user_id = %s", (user_id,))
+        result = cursor.fetchone()[0]
+        cursor.close()
+    finally:
+        conn.close()
+    return result
+
+@contextmanager
+def named_lock(name):
+    """Verrou nommé MySQL sans attente : produit True si obtenu, False s'il est déjà pris
+
+    La connexion reste empruntée tant que le verrou est tenu.
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (name,))
+        acquired = cursor.fetchone()[0] == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+                cursor.fetchone()
+            cursor.close()
+    finally:
+        conn.close()
+
 def create_new_topic(user_id, username, title):
     """Crée explicitement un nouveau sujet de discussion"""
     return create_topic(user_id, username, title)
-
-# Initialiser la base de données au démarrage
-init_database()
-
-print("Fonctions disponibles dans mysql_client :", dir())
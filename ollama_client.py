@@ -0,0 +1,297 @@
+import os
+import logging
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import httpx
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+# Durée pendant laquelle Ollama garde le modèle chargé après une requête
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Intervalle de la requête de maintien en mémoire (secondes, 0 pour désactiver)
+OLLAMA_WARM_INTERVAL = float(os.getenv("OLLAMA_WARM_INTERVAL", 600))
+# Délais (secondes) : établissement de la connexion, puis attente maximale entre deux
+# lectures. En flux, chaque morceau réarme le délai de lecture ; sans flux, il couvre
+# toute la génération.
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 5))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", 180))
+# Pool de connexions persistantes vers Ollama
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 20))
+OLLAMA_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_KEEPALIVE_CONNECTIONS", 10))
+# Disjoncteur : échecs consécutifs avant ouverture, puis délai avant une nouvelle tentative
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", 3))
+OLLAMA_BREAKER_RESET = float(os.getenv("OLLAMA_BREAKER_RESET", 30))
+# Intervalle de la vérification de santé (secondes)
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", 15))
+
+class OllamaUnavailable(Exception):
+    """Ollama est considéré hors service : l'appel est refusé sans être tenté"""
+
+class CircuitBreaker:
+    """Refuse les appels après plusieurs échecs consécutifs
+
+    Une fois ouvert, un seul appel d'essai est laissé passer après
+    `reset_timeout` secondes : son succès referme le disjoncteur, son échec
+    le rouvre pour un nouveau délai.
+    """
+
+    def __init__(self, failure_threshold=OLLAMA_BREAKER_FAILURES, reset_timeout=OLLAMA_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Vrai si un appel peut être tenté maintenant"""
+        if self.opened_at is None:
+            return True
+        return not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def check(self):
+        if not self.allow():
+            raise OllamaUnavailable("Ollama indisponible")
+        if self.opened_at is not None:
+            self._probing = True
+
+    def release(self):
+        """Appel interrompu sans issue connue : un nouvel essai pourra être tenté"""
+        self._probing = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("✅ Ollama de nouveau disponible")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"⛔ Ollama indisponible après {self.failures} échecs, appels suspendus")
+            self.opened_at = time.monotonic()
+
+breaker = CircuitBreaker()
+metrics.track_circuit("ollama", lambda: breaker.is_open)
+
+# Téléchargements en cours : modèle -> {"status", "completed", "total"}
+pull_progress = {}
+
+def is_available(model=OLLAMA_MODEL):
+    """Vrai si une génération peut être tentée (disjoncteur fermé, modèle non en téléchargement)"""
+    return breaker.allow() and model not in pull_progress
+
+def pull_percent(model=OLLAMA_MODEL):
+    """Avancement du téléchargement du modèle (0-100) ou None"""
+    progress = pull_progress.get(model)
+    if not progress or not progress.get("total"):
+        return None
+    return int(100 * progress["completed"] / progress["total"])
+
+_client = None
+
+def get_client():
+    """Client HTTP asynchrone partagé (connexions persistantes réutilisées entre les appels)"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=OLLAMA_URL,
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS,
+                                max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _is_outage(error):
+    """Erreurs qui signalent un Ollama défaillant (et non une requête invalide)"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+@asynccontextmanager
+async def _guarded():
+    """Soumet un appel au disjoncteur et lui rapporte son issue"""
+    breaker.check()
+    try:
+        yield
+    except Exception as e:
+        if _is_outage(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        # Annulation : l'appel ne dit rien de l'état d'Ollama
+        breaker.release()
+        raise
+    breaker.record_success()
+
+async def _post(path, payload):
+    async with _guarded():
+        response = await get_client().post(path, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+async def chat(messages, model=OLLAMA_MODEL):
+    """Réponse complète via /api/chat (messages : [{"role", "content"}, ...])"""
+    result = await _post(
+        "/api/chat",
+        {"model": model, "messages": messages, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE}
+    )
+    metrics.observe_ollama(result)
+    return result["message"]["content"]
+
+async def stream_chat(messages, model=OLLAMA_MODEL):
+    """Réponse en flux via /api/chat
+
+    Ollama réutilise le cache KV du préfixe commun (système + historique)
+    d'un tour à l'autre : seul le nouveau message est réencodé.
+    """
+    async with _guarded(), get_client().stream(
+        "POST",
+        "/api/chat",
+        json={"model": model, "messages": messages, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE}
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            content = chunk.get("message", {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                metrics.observe_ollama(chunk)
+                break
+
+# Derniers embeddings calculés : le routage et la recherche de souvenirs embeddent le même message
+_EMBED_MEMO_SIZE = 256
+_embed_memo = OrderedDict()
+
+async def embed(text, model=OLLAMA_EMBED_MODEL):
+    """Vecteur d'embedding d'un texte via /api/embeddings"""
+    key = (model, text)
+    if key in _embed_memo:
+        _embed_memo.move_to_end(key)
+        return _embed_memo[key]
+    result = await _post(
+        "/api/embeddings",
+        {"model": model, "prompt": text, "keep_alive": OLLAMA_KEEP_ALIVE}
+    )
+    vector = result["embedding"]
+    _embed_memo[key] = vector
+    if len(_embed_memo) > _EMBED_MEMO_SIZE:
+        _embed_memo.popitem(last=False)
+    return vector
+
+async def embed_many(texts, model=OLLAMA_EMBED_MODEL):
+    """Embeddings de plusieurs textes en une requête via /api/embed"""
+    result = await _post(
+        "/api/embed",
+        {"model": model, "input": texts, "keep_alive": OLLAMA_KEEP_ALIVE}
+    )
+    return result["embeddings"]
+
+async def list_models():
+    """Noms (sans étiquette) des modèles présents dans Ollama"""
+    async with _guarded():
+        response = await get_client().get("/api/tags")
+        response.raise_for_status()
+    return {m["name"].split(":")[0] for m in response.json().get("models", [])}
+
+async def pull_model(model):
+    """Télécharge un modèle en suivant l'avancement rapporté par /api/pull"""
+    logger.info(f"🔄 {model} non présent, téléchargement en cours...")
+    pull_progress[model] = {"status": "starting", "completed": 0, "total": 0}
+    last_logged = -10
+    try:
+        # Pas de délai de lecture : le téléchargement d'une couche peut être long
+        async with get_client().stream("POST", "/api/pull", json={"name": model, "stream": True},
+                                       timeout=httpx.Timeout(None, connect=OLLAMA_CONNECT_TIMEOUT)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                progress = pull_progress[model]
+                progress["status"] = chunk.get("status", progress["status"])
+                if chunk.get("total"):
+                    progress["total"] = chunk["total"]
+                    progress["completed"] = chunk.get("completed", 0)
+                    percent = pull_percent(model)
+                    if percent >= last_logged + 10:
+                        logger.info(f"⬇️  {model} : {percent} %")
+                        last_logged = percent
+    finally:
+        pull_progress.pop(model, None)
+    logger.info(f"✔️  {model} téléchargé")
+
+async def ensure_model(model=OLLAMA_MODEL, load=True):
+    """Télécharge le modèle s'il est absent puis le charge en mémoire"""
+    if model not in await list_models():
+        await pull_model(model)
+    if load:
+        await load_model(model)
+
+async def load_model(model=OLLAMA_MODEL):
+    """Requête sans prompt : charge le modèle et prolonge son maintien en mémoire"""
+    await _post("/api/generate", {"model": model, "keep_alive": OLLAMA_KEEP_ALIVE})
+
+async def keep_model_loaded(model=OLLAMA_MODEL, interval=OLLAMA_WARM_INTERVAL,
+                            health_interval=OLLAMA_HEALTH_INTERVAL):
+    """Tâche de fond : prépare le modèle, surveille Ollama et le garde chargé
+
+    La vérification de santé referme le disjoncteur dès qu'Ollama répond à
+    nouveau ; le modèle est alors (re)téléchargé si besoin puis rechargé.
+    """
+    ready = False
+    last_warm = time.monotonic()
+    while True:
+        try:
+            if not ready:
+                await ensure_model(model)
+                ready = True
+                last_warm = time.monotonic()
+            elif interval and time.monotonic() - last_warm >= interval:
+                await load_model(model)
+                last_warm = time.monotonic()
+            else:
+                async with _guarded():
+                    response = await get_client().get("/api/version")
+                    response.raise_for_status()
+        except OllamaUnavailable:
+            # Disjoncteur ouvert en attendant son délai : sonde directe, hors disjoncteur
+            try:
+                response = await get_client().get("/api/version")
+                response.raise_for_status()
+                breaker.record_success()
+                ready = False
+            except Exception:
+                pass
+        except Exception as e:
+            logger.warning(f"❌ Ollama injoignable ou modèle {model} indisponible : {e}")
+            ready = False
+        await asyncio.sleep(health_interval)
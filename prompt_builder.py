@@ -0,0 +1,107 @@
+import os
+import logging
+import vector_index
+from redis_client import get_user_history, seed_history
+from mysql_client import get_messages_by_topic, run_db
+
+logger = logging.getLogger(__name__)
+
+# Budget de tokens pour le prompt envoyé à Mistral (système + historique + message)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 3000))
+# Nombre d'entrées (questions et réponses) lues dans la mémoire récente
+PROMPT_HISTORY_ENTRIES = int(os.getenv("PROMPT_HISTORY_ENTRIES", 20))
+# Souvenirs de conversations passées ajoutés au prompt (index vectoriel)
+PROMPT_RECALL_K = int(os.getenv("PROMPT_RECALL_K", 4))
+PROMPT_RECALL_TOKENS = int(os.getenv("PROMPT_RECALL_TOKENS", 800))
+PROMPT_RECALL_MIN_SCORE = float(os.getenv("PROMPT_RECALL_MIN_SCORE", 0.5))
+SYSTEM_PROMPT = os.getenv(
+    "OLLAMA_SYSTEM_PROMPT",
+    "Tu es TalkWise, un assistant qui répond en tenant compte de la conversation en cours."
+)
+
+def estimate_tokens(text):
+    """Estimation rapide : environ 4 caractères par token"""
+    return len(text) // 4 + 1
+
+async def load_recent_history(user_id, topic_id=None, limit=PROMPT_HISTORY_ENTRIES):
+    """Historique récent depuis Redis, ou depuis MySQL si la mémoire Redis est vide"""
+    entries = await get_user_history(user_id, limit)
+    if not entries and topic_id:
+        rows = await run_db(get_messages_by_topic, topic_id, limit=limit // 2)
+        for message_user, message_bot, timestamp, _ in rows:
+            ts = int(timestamp.timestamp()) if timestamp else None
+            entries.append({"role": "user", "text": message_user, "timestamp": ts, "topic_id": topic_id})
+            entries.append({"role": "bot", "text": message_bot, "timestamp": ts, "topic_id": topic_id})
+        # Les tours suivants trouveront cet historique dans Redis
+        await seed_history(user_id, entries)
+
+    # On ne garde que le sujet en cours (les anciennes entrées n'ont pas de sujet)
+    if topic_id:
+        entries = [e for e in entries if e.get("topic_id") in (None, topic_id)]
+    return entries
+
+def format_memories(memories, budget=PROMPT_RECALL_TOKENS):
+    """Bloc de souvenirs pertinents, dans la limite de son budget de tokens"""
+    lines = []
+    used = 0
+    for message_user, message_bot, timestamp in memories:
+        date_str = timestamp.strftime("%d/%m/%Y") if timestamp else "?"
+        line = f"- [{date_str}] Utilisateur : {message_user}\n  Toi : {message_bot}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    if not lines:
+        return None
+    return "Extraits de conversations passées avec cet utilisateur, à utiliser s'ils sont utiles :\n" + "\n".join(lines)
+
+def build_messages(history, user_message, budget=PROMPT_TOKEN_BUDGET, system_prompt=SYSTEM_PROMPT, memories=None):
+    """Messages pour /api/chat : système, historique le plus récent possible, puis la question
+
+    Les souvenirs sont placés juste avant la question : le préfixe système +
+    historique reste identique d'un tour à l'autre pour le cache KV d'Ollama.
+    """
+    used = estimate_tokens(system_prompt) + estimate_tokens(user_message)
+    if memories:
+        used += estimate_tokens(memories)
+    kept = []
+    for entry in reversed(history):
+        cost = estimate_tokens(entry["text"])
+        if used + cost > budget:
+            break
+        kept.append(entry)
+        used += cost
+
+    # L'historique doit commencer par une question de l'utilisateur
+    while kept and kept[-1]["role"] != "user":
+        kept.pop()
+
+    messages = [{"role": "system", "content": system_prompt}]
+    for entry in reversed(kept):
+        role = "assistant" if entry["role"] == "bot" else "user"
+        messages.append({"role": role, "content": entry["text"]})
+    if memories:
+        messages.append({"role": "system", "content": memories})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+async def build_prompt(user_id, user_message, topic_id=None, budget=PROMPT_TOKEN_BUDGET):
+    """Assemble le contexte de conversation à envoyer à Mistral"""
+    try:
+        history = await load_recent_history(user_id, topic_id)
+    except Exception as e:
+        logger.warning(f"Historique indisponible, réponse sans contexte: {e}")
+        history = []
+
+    memories = None
+    if vector_index.VECTOR_INDEX_ENABLED and PROMPT_RECALL_K:
+        try:
+            recalled = await vector_index.recall(user_id, user_message, PROMPT_RECALL_K + len(history), PROMPT_RECALL_MIN_SCORE)
+            # Les échanges déjà présents dans l'historique récent ne sont pas répétés
+            recent = {entry["text"] for entry in history}
+            recalled = [m for m in recalled if m[0] not in recent][:PROMPT_RECALL_K]
+            memories = format_memories(recalled)
+        except Exception as e:
+            logger.warning(f"Souvenirs indisponibles: {e}")
+    return build_messages(history, user_message, budget, memories=memories)
@@ -1,19 +1,206 @@
 import os
-import redis
+import sys
+import json
+import time
+import zlib
+import asyncio
+import msgpack
+import zstandard
+import redis.asyncio as redis
+from redis.exceptions import WatchError
 
 redis_host = os.getenv("REDIS_HOST", "localhost")
 redis_port = int(os.getenv("REDIS_PORT", 6379))
 
+# Nombre d'entrées conservées par utilisateur et durée de vie après la dernière activité
+HISTORY_WINDOW = int(os.getenv("REDIS_HISTORY_WINDOW", 40))
+HISTORY_TTL = int(os.getenv("REDIS_HISTORY_TTL", 7 * 24 * 3600))
+# Textes compressés au-delà de cette taille (octets UTF-8) : zstd, zlib ou none
+HISTORY_COMPRESSION = os.getenv("REDIS_HISTORY_COMPRESSION", "zstd")
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("REDIS_HISTORY_COMPRESS_MIN_BYTES", 256))
+
 r = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+# Client binaire réservé à la mémoire des conversations (entrées msgpack)
+rb = redis.Redis(host=redis_host, port=redis_port, decode_responses=False)
+
+def _history_key(user_id):
+    return f"user:{user_id}:messages"
+
+# Entrée : tableau msgpack [rôle, horodatage, topic_id, codec, texte]
+#   codec 0 : texte en clair (str), 1 : zlib, 2 : zstd (bin)
+# Un tableau msgpack de 5 éléments commence toujours par l'octet 0x95, ce qui le
+# distingue des anciens formats JSON ("{...}") et texte ("user: ...").
+_ENTRY_MARKER = 0x95
+_CODEC_PLAIN, _CODEC_ZLIB, _CODEC_ZSTD = 0, 1, 2
+_CODECS = {"none": _CODEC_PLAIN, "zlib": _CODEC_ZLIB, "zstd": _CODEC_ZSTD}
+_zstd_compressor = zstandard.ZstdCompressor(level=3)
+_zstd_decompressor = zstandard.ZstdDecompressor()
+
+def _compress(data):
+    codec = _CODECS[HISTORY_COMPRESSION]
+    if codec == _CODEC_ZSTD:
+        return codec, _zstd_compressor.compress(data)
+    if codec == _CODEC_ZLIB:
+        return codec, zlib.compress(data, 6)
+    return _CODEC_PLAIN, data
+
+def _decompress(codec, payload):
+    if codec == _CODEC_ZSTD:
+        return _zstd_decompressor.decompress(payload).decode("utf-8")
+    if codec == _CODEC_ZLIB:
+        return zlib.decompress(payload).decode("utf-8")
+    return payload
+
+def encode_entry(role, text, topic_id=None, timestamp=None):
+    """Entrée binaire compacte ; les textes longs sont compressés s'ils y gagnent"""
+    codec, payload = _CODEC_PLAIN, text
+    data = text.encode("utf-8")
+    if len(data) >= HISTORY_COMPRESS_MIN_BYTES:
+        compressed_codec, compressed = _compress(data)
+        if len(compressed) < len(data):
+            codec, payload = compressed_codec, compressed
+    return msgpack.packb([role, int(timestamp or time.time()), topic_id or None, codec, payload])
+
+def _entry_from_record(record):
+    role, timestamp, topic_id, codec, payload = record
+    return {"role": role, "text": _decompress(codec, payload), "timestamp": timestamp, "topic_id": topic_id}
+
+def _decode_legacy(raw):
+    """Anciens formats : JSON {"r", "t", "ts", "tp"} puis texte "user: ..." """
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    if raw.startswith("{"):
+        try:
+            entry = json.loads(raw)
+            return {"role": entry["r"], "text": entry["t"], "timestamp": entry.get("ts"), "topic_id": entry.get("tp")}
+        except (ValueError, KeyError):
+            pass
+    role, sep, text = raw.partition(": ")
+    if not sep or role not in ("user", "bot"):
+        role, text = "user", raw
+    return {"role": role, "text": text, "timestamp": None, "topic_id": None}
+
+def decode_entry(raw):
+    """Retourne {"role", "text", "timestamp", "topic_id"} ; accepte les anciens formats"""
+    if raw[:1] == bytes([_ENTRY_MARKER]):
+        return _entry_from_record(msgpack.unpackb(raw))
+    return _decode_legacy(raw)
+
+def decode_entries(raws):
+    """Décode une liste d'entrées : un seul Unpacker sur leur concaténation"""
+    if all(raw[:1] == bytes([_ENTRY_MARKER]) for raw in raws):
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(b"".join(raws))
+        return [_entry_from_record(record) for record in unpacker]
+    return [decode_entry(raw) for raw in raws]
+
+async def save_exchange(user_id, user_message, bot_reply, topic_id=None):
+    """Enregistre la question et la réponse en un seul aller-retour (MULTI/EXEC)"""
+    key = _history_key(user_id)
+    now = time.time()
+    async with rb.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, encode_entry("user", user_message, topic_id, now), encode_entry("bot", bot_reply, topic_id, now))
+        pipe.ltrim(key, -HISTORY_WINDOW, -1)
+        pipe.expire(key, HISTORY_TTL)
+        await pipe.execute()
+
+async def save_user_message(user_id, message, role="user", topic_id=None):
+    key = _history_key(user_id)
+    async with rb.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, encode_entry(role, message, topic_id))
+        pipe.ltrim(key, -HISTORY_WINDOW, -1)
+        pipe.expire(key, HISTORY_TTL)
+        await pipe.execute()
+
+async def seed_history(user_id, entries):
+    """Remplit la mémoire d'un utilisateur (entrées décodées) si elle est vide"""
+    key = _history_key(user_id)
+    if not entries:
+        return
+    encoded = [encode_entry(e["role"], e["text"], e.get("topic_id"), e.get("timestamp")) for e in entries]
+    if await rb.exists(key):
+        return
+    async with rb.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, *encoded)
+        pipe.ltrim(key, -HISTORY_WINDOW, -1)
+        pipe.expire(key, HISTORY_TTL)
+        await pipe.execute()
+
+async def get_user_history(user_id, limit=10):
+    key = _history_key(user_id)
+    return decode_entries(await rb.lrange(key, -limit, -1))
+
+async def clear_user_history(user_id):
+    key = _history_key(user_id)
+    await rb.delete(key)
+
+async def migrate_history_entries(scan_count=500):
+    """Réencode en msgpack les mémoires de conversation aux anciens formats, clé par clé
+
+    Chaque clé est remplacée dans une transaction surveillée (WATCH) : un message
+    ajouté pendant la conversion fait recommencer la clé. La durée de vie restante
+    est conservée. Retourne (clés converties, clés parcourues).
+    """
+    converted = scanned = 0
+    async for key in rb.scan_iter(match=_history_key("*"), count=scan_count):
+        scanned += 1
+        async with rb.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raws = await pipe.lrange(key, 0, -1)
+                    if not raws or all(raw[:1] == bytes([_ENTRY_MARKER]) for raw in raws):
+                        await pipe.unwatch()
+                        break
+                    ttl = await pipe.pttl(key)
+                    encoded = [encode_entry(e["role"], e["text"], e["topic_id"], e["timestamp"])
+                               for e in decode_entries(raws)]
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.rpush(key, *encoded)
+                    if ttl > 0:
+                        pipe.pexpire(key, ttl)
+                    await pipe.execute()
+                    converted += 1
+                    break
+                except WatchError:
+                    continue
+    return converted, scanned
+
+async def memory_report(patterns=("user:*:messages", "user:*:active_topic"), scan_count=1000):
+    """Mémoire utilisée par motif de clé : nombre de clés, octets totaux et moyens"""
+    report = {}
+    for pattern in patterns:
+        keys = 0
+        total = 0
+        batch = []
+        async for key in r.scan_iter(match=pattern, count=scan_count):
+            batch.append(key)
+            if len(batch) >= scan_count:
+                keys, total = await _add_usage(batch, keys, total)
+                batch = []
+        if batch:
+            keys, total = await _add_usage(batch, keys, total)
+        report[pattern] = {"keys": keys, "bytes": total, "avg_bytes": total // keys if keys else 0}
+    return report
 
-def save_user_message(user_id, message):
-    key = f"user:{user_id}:messages"
-    r.rpush(key, message)
+async def _add_usage(keys, count, total):
+    async with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.memory_usage(key)
+        usages = await pipe.execute()
+    return count + len(keys), total + sum(u or 0 for u in usages)
 
-def get_user_history(user_id, limit=10):
-    key = f"user:{user_id}:messages"
-    return r.lrange(key, -limit, -1)
+async def close():
+    await r.aclose()
+    await rb.aclose()
 
-def clear_user_history(user_id):
-    key = f"user:{user_id}:messages"
-    r.delete(key)
+if __name__ == "__main__":
+    # python redis_client.py migrate : convertit les mémoires existantes au format msgpack
+    if sys.argv[1:] == ["migrate"]:
+        converted, scanned = asyncio.run(migrate_history_entries())
+        print(f"{converted} clés converties sur {scanned}")
+        sys.exit(0)
+    # python redis_client.py : affiche le rapport mémoire
+    for pattern, usage in asyncio.run(memory_report()).items():
+        print(f"{pattern}: {usage['keys']} clés, {usage['bytes']} octets (moyenne {usage['avg_bytes']})")
@@ -0,0 +1,106 @@
+import os
+import logging
+import re
+import json
+import time
+import hashlib
+import unicodedata
+from redis.exceptions import RedisError
+from redis_client import r
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000))
+
+_PREFIX = "llm_cache"
+_INDEX_KEY = f"{_PREFIX}:index"      # zset : clé -> date d'insertion (éviction des plus anciennes)
+_OPTOUT_KEY = f"{_PREFIX}:optout"    # utilisateurs qui refusent le cache
+_STATS_KEY = f"{_PREFIX}:stats"      # compteurs partagés entre instances
+
+stats = {"hits": 0, "misses": 0, "bypass": 0}
+
+def normalize_prompt(text):
+    """Minuscules, espaces compactés, ponctuation finale retirée"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" .!?…")
+
+def context_hash(messages):
+    """Empreinte du contexte (système + historique), sans la dernière question"""
+    payload = json.dumps(messages[:-1], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def cache_key(messages, model):
+    prompt = normalize_prompt(messages[-1]["content"])
+    digest = hashlib.sha256(f"{model}\x00{context_hash(messages)}\x00{prompt}".encode("utf-8")).hexdigest()
+    return f"{_PREFIX}:{digest}"
+
+async def is_opted_out(user_id):
+    return bool(await r.sismember(_OPTOUT_KEY, user_id))
+
+async def set_opt_out(user_id, opted_out):
+    if opted_out:
+        await r.sadd(_OPTOUT_KEY, user_id)
+    else:
+        await r.srem(_OPTOUT_KEY, user_id)
+
+async def lookup(user_id, messages, model):
+    """Réponse en cache pour ces messages, ou None"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.sismember(_OPTOUT_KEY, user_id)
+            pipe.get(cache_key(messages, model))
+            opted_out, reply = await pipe.execute()
+        if opted_out:
+            stats["bypass"] += 1
+            return None
+        counter = "hits" if reply is not None else "misses"
+        stats[counter] += 1
+        metrics.cache_result("response", reply is not None)
+        await r.hincrby(_STATS_KEY, counter, 1)
+        return reply
+    except RedisError as e:
+        logger.warning(f"Cache des réponses indisponible: {e}")
+        return None
+
+async def store(user_id, messages, model, reply):
+    """Met la réponse en cache et évince les entrées les plus anciennes au-delà de la limite"""
+    if not RESPONSE_CACHE_ENABLED or not reply:
+        return
+    key = cache_key(messages, model)
+    now = time.time()
+    try:
+        if await r.sismember(_OPTOUT_KEY, user_id):
+            return
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.set(key, reply, ex=RESPONSE_CACHE_TTL)
+            pipe.zadd(_INDEX_KEY, {key: now})
+            # Les entrées expirées sont retirées de l'index
+            pipe.zremrangebyscore(_INDEX_KEY, 0, now - RESPONSE_CACHE_TTL)
+            pipe.zcard(_INDEX_KEY)
+            size = (await pipe.execute())[-1]
+        if size > RESPONSE_CACHE_MAX_ENTRIES:
+            evicted = await r.zpopmin(_INDEX_KEY, size - RESPONSE_CACHE_MAX_ENTRIES)
+            if evicted:
+                await r.delete(*[k for k, _ in evicted])
+    except RedisError as e:
+        logger.warning(f"Cache des réponses indisponible: {e}")
+
+async def get_stats():
+    """Compteurs locaux et globaux (toutes instances) avec le taux de succès"""
+    shared = await r.hgetall(_STATS_KEY)
+    hits = int(shared.get("hits", 0))
+    misses = int(shared.get("misses", 0))
+    total = hits + misses
+    return {
+        "local": dict(stats),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "entries": await r.zcard(_INDEX_KEY),
+    }
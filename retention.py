@@ -0,0 +1,181 @@
+import os
+import io
+import json
+import logging
+import asyncio
+from datetime import datetime
+import zstandard
+from mysql_client import (
+    get_messages_before, delete_messages, get_first_message_id, get_user_topics,
+    iter_history_since, named_lock, run_db,
+)
+
+logger = logging.getLogger(__name__)
+
+# Mois complets conservés dans la table messages, en plus du mois en cours (0 : désactivé,
+# aucun message n'est jamais supprimé)
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", 0))
+# Intervalle entre deux passes d'archivage (secondes)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", 86400))
+# Messages archivés puis supprimés par lot (une transaction DELETE courte par lot)
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 2000))
+# Obligatoire si la rétention est active : volume persistant, partagé par toutes les
+# répliques (les archives sont la seule copie des messages supprimés et /export les lit)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", 10))
+RETENTION_LOCK_NAME = "talkwise_retention"
+
+# Archives : {ARCHIVE_DIR}/{user_id}/{AAAA-MM}.jsonl.zst, un message JSON par ligne.
+# Chaque lot ajoute une trame zstd au fichier ; les trames sont lues à la suite.
+# Les identifiants sont croissants dans un fichier : une ligne dont l'id n'est pas
+# supérieur au précédent provient d'un lot rejoué après une interruption.
+
+def retention_cutoff(now=None, months=RETENTION_MONTHS):
+    """Premier jour du plus ancien mois conservé en base"""
+    now = now or datetime.utcnow()
+    index = now.year * 12 + now.month - 1 - months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def _on_mounted_volume(path):
+    """Vrai si `path` se trouve sur un point de montage autre que la racine du conteneur"""
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path != os.path.sep
+
+def check_archive_dir():
+    """Refuse d'archiver (donc de supprimer) sans répertoire d'archives persistant"""
+    if not ARCHIVE_DIR:
+        raise RuntimeError("ARCHIVE_DIR doit être défini pour activer la rétention")
+    if not _on_mounted_volume(ARCHIVE_DIR):
+        raise RuntimeError(f"ARCHIVE_DIR ({ARCHIVE_DIR}) doit se trouver sur un volume monté")
+
+def _archive_path(user_id, month):
+    return os.path.join(ARCHIVE_DIR, str(user_id), f"{month}.jsonl.zst")
+
+def _append_archives(rows):
+    """Ajoute les lignes aux archives de leur utilisateur et de leur mois"""
+    groups = {}
+    for message_id, user_id, username, topic_id, message_user, message_bot, timestamp in rows:
+        record = {
+            "id": message_id, "username": username, "topic_id": topic_id,
+            "message_user": message_user, "message_bot": message_bot,
+            "timestamp": timestamp.isoformat(),
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        groups.setdefault((user_id, timestamp.strftime("%Y-%m")), []).append(line.encode("utf-8"))
+
+    compressor = zstandard.ZstdCompressor(level=ARCHIVE_COMPRESSION_LEVEL)
+    for (user_id, month), lines in groups.items():
+        path = _archive_path(user_id, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(compressor.compress(b"".join(lines)))
+            f.flush()
+            # Archive sur disque avant la suppression des lignes en base
+            os.fsync(f.fileno())
+
+def archive_old_messages(cutoff=None, batch_size=RETENTION_BATCH_SIZE):
+    """Archive puis supprime, par lots, les messages antérieurs à `cutoff`
+
+    Retourne le nombre de messages archivés. Une seule instance travaille à la
+    fois (verrou nommé MySQL) ; les autres retournent 0 immédiatement.
+    """
+    check_archive_dir()
+    cutoff = cutoff or retention_cutoff()
+    total = 0
+    with named_lock(RETENTION_LOCK_NAME) as acquired:
+        if not acquired:
+            logger.info("Archivage déjà en cours sur une autre instance")
+            return 0
+        while True:
+            rows = get_messages_before(cutoff, batch_size)
+            if not rows:
+                break
+            _append_archives(rows)
+            delete_messages([row[0] for row in rows])
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    if total:
+        logger.info(f"🗄️  {total} messages antérieurs au {cutoff:%Y-%m-%d} archivés")
+    return total
+
+def iter_archive(user_id):
+    """Parcourt les messages archivés d'un utilisateur, mois par mois, sans tout charger"""
+    if not ARCHIVE_DIR:
+        return
+    directory = os.path.join(ARCHIVE_DIR, str(user_id))
+    if not os.path.isdir(directory):
+        return
+    decompressor = zstandard.ZstdDecompressor()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".jsonl.zst"):
+            continue
+        last_id = 0
+        with open(os.path.join(directory, name), "rb") as f:
+            reader = decompressor.stream_reader(f, read_across_frames=True)
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                record = json.loads(line)
+                if record["id"] <= last_id:
+                    continue
+                last_id = record["id"]
+                yield record
+
+def export_history(user_id, path):
+    """Écrit tout l'historique de l'utilisateur (archives puis base) dans `path`, en JSONL
+
+    Retourne le nombre de messages écrits.
+    """
+    titles = {topic_id: title for topic_id, title, _ in get_user_topics(user_id)}
+    # Un lot interrompu peut être à la fois archivé et encore en base : seuls les ids
+    # archivés au-delà du plus ancien message en base sont retenus pour l'écarter
+    first_live_id = get_first_message_id(user_id)
+    duplicates = set()
+    count = 0
+    with open(path, "w", encoding="utf-8") as out:
+        for record in iter_archive(user_id):
+            if first_live_id is not None and record["id"] >= first_live_id:
+                duplicates.add(record["id"])
+            out.write(json.dumps({
+                "id": record["id"],
+                "timestamp": record["timestamp"],
+                "topic": titles.get(record["topic_id"], "Conversation sans sujet"),
+                "message_user": record["message_user"],
+                "message_bot": record["message_bot"],
+            }, ensure_ascii=False) + "\n")
+            count += 1
+        for message_id, message_user, message_bot, timestamp, title, _ in iter_history_since(user_id, "1970-01-01"):
+            if message_id in duplicates:
+                continue
+            out.write(json.dumps({
+                "id": message_id,
+                "timestamp": timestamp.isoformat(),
+                "topic": title,
+                "message_user": message_user,
+                "message_bot": message_bot,
+            }, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+async def run_periodically(interval=RETENTION_INTERVAL):
+    """Tâche de fond : archive les mois sortis de la période de rétention"""
+    try:
+        check_archive_dir()
+    except RuntimeError as e:
+        logger.error(f"❌ Rétention désactivée : {e}")
+        return
+    while True:
+        try:
+            await run_db(archive_old_messages)
+        except Exception as e:
+            logger.error(f"❌ Archivage des anciens messages impossible : {e}")
+        await asyncio.sleep(interval)
+
+if __name__ == "__main__":
+    # Passe d'archivage ponctuelle (cron) : python retention.py
+    from mysql_client import init_database
+    from logging_setup import configure_logging
+    configure_logging()
+    init_database()
+    archive_old_messages()
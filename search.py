@@ -0,0 +1,78 @@
+import os
+import logging
+import re
+import json
+import hashlib
+from datetime import datetime
+from redis.exceptions import RedisError
+from redis_client import r
+import metrics
+from mysql_client import search_messages, run_db
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 5))
+# Durée de vie des résultats en cache (0 pour désactiver le cache)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 300))
+SNIPPET_LENGTH = 160
+
+def normalize_terms(terms):
+    return re.sub(r"\s+", " ", terms.strip().lower())
+
+def _cache_key(user_id, terms, page):
+    digest = hashlib.sha1(normalize_terms(terms).encode("utf-8")).hexdigest()
+    return f"search:{user_id}:{digest}:{page}"
+
+async def search_history(user_id, terms, page=1):
+    """Résultats d'une page de recherche : (liste de dicts, y a-t-il une page suivante ?)"""
+    key = _cache_key(user_id, terms, page)
+    if SEARCH_CACHE_TTL:
+        try:
+            cached = await r.get(key)
+            metrics.cache_result("search", cached is not None)
+            if cached is not None:
+                data = json.loads(cached)
+                for item in data["results"]:
+                    item["timestamp"] = datetime.fromisoformat(item["timestamp"]) if item["timestamp"] else None
+                return data["results"], data["has_more"]
+        except RedisError as e:
+            logger.warning(f"Cache de recherche indisponible: {e}")
+
+    # Une ligne de plus que la page pour savoir s'il existe une page suivante
+    rows = await run_db(search_messages, user_id, terms, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE)
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    results = [
+        {"id": message_id, "message_user": message_user, "message_bot": message_bot,
+         "timestamp": timestamp, "title": title, "score": float(score)}
+        for message_id, message_user, message_bot, timestamp, title, score in rows[:SEARCH_PAGE_SIZE]
+    ]
+
+    if SEARCH_CACHE_TTL:
+        try:
+            payload = [dict(item, timestamp=item["timestamp"].isoformat() if item["timestamp"] else None)
+                       for item in results]
+            await r.set(key, json.dumps({"results": payload, "has_more": has_more}, ensure_ascii=False),
+                        ex=SEARCH_CACHE_TTL)
+        except RedisError as e:
+            logger.warning(f"Cache de recherche indisponible: {e}")
+    return results, has_more
+
+def snippet(text, terms, length=SNIPPET_LENGTH):
+    """Extrait du texte autour du premier terme trouvé"""
+    text = re.sub(r"\s+", " ", text or "")
+    lowered = text.lower()
+    positions = [lowered.find(word) for word in normalize_terms(terms).split() if lowered.find(word) >= 0]
+    start = max(0, min(positions) - length // 3) if positions else 0
+    extract = text[start:start + length]
+    return ("…" if start > 0 else "") + extract + ("…" if start + length < len(text) else "")
+
+def format_results(results, terms, page, has_more):
+    lines = [f"🔎 Résultats pour « {terms} » (page {page}) :\n"]
+    for item in results:
+        date_str = item["timestamp"].strftime("%d/%m/%Y %H:%M") if item["timestamp"] else "?"
+        lines.append(f"• {item['title']} — {date_str}")
+        lines.append(f"  👤 {snippet(item['message_user'], terms)}")
+        lines.append(f"  🤖 {snippet(item['message_bot'], terms)}\n")
+    if has_more:
+        lines.append(f"Page suivante : /search {terms} page {page + 1}")
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+from telegram.error import BadRequest, RetryAfter
+import metrics
+
+TELEGRAM_MAX_LENGTH = 4096
+# Intervalle minimal entre deux éditions et nombre minimal de nouveaux caractères
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", 40))
+PLACEHOLDER = "✍️ ..."
+CURSOR = " ▌"
+
+def split_message(text, limit=TELEGRAM_MAX_LENGTH):
+    """Découpe un texte en morceaux acceptés par Telegram, de préférence sur un saut de ligne"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+class ProgressiveReply:
+    """Réponse Telegram mise à jour au fur et à mesure de la génération"""
+
+    def __init__(self, message, interval=STREAM_EDIT_INTERVAL, min_chars=STREAM_EDIT_MIN_CHARS):
+        self._source = message
+        self._interval = interval
+        self._min_chars = min_chars
+        self._messages = []   # messages Telegram envoyés
+        self._shown = []      # texte actuellement affiché dans chacun
+        self._text = ""
+        self._flushed_len = 0
+        self._next_edit = 0.0
+
+    @property
+    def text(self):
+        return self._text
+
+    async def start(self):
+        """Envoie le message d'attente qui sera ensuite édité"""
+        with metrics.stage("telegram_send"):
+            self._messages.append(await self._source.reply_text(PLACEHOLDER))
+        self._shown.append(PLACEHOLDER)
+        self._next_edit = time.monotonic() + self._interval
+
+    async def append(self, piece):
+        """Ajoute un morceau de texte ; l'édition n'a lieu que si elle est due"""
+        self._text += piece
+        if (len(self._text) - self._flushed_len >= self._min_chars
+                and time.monotonic() >= self._next_edit):
+            await self._flush(final=False)
+
+    async def finish(self):
+        """Affiche le texte complet et le retourne"""
+        await self._flush(final=True)
+        return self._text
+
+    async def fail(self, error_text):
+        """Remplace le message d'attente par un message d'erreur"""
+        if self._text:
+            self._text += f"\n\n{error_text}"
+        else:
+            self._text = error_text
+        await self._flush(final=True)
+
+    async def _flush(self, final):
+        parts = split_message(self._text) if self._text else [PLACEHOLDER]
+        if not final:
+            parts[-1] = parts[-1][:TELEGRAM_MAX_LENGTH - len(CURSOR)] + CURSOR
+
+        for index, part in enumerate(parts):
+            try:
+                if index < len(self._messages):
+                    if self._shown[index] != part:
+                        with metrics.stage("telegram_edit"):
+                            await self._messages[index].edit_text(part)
+                        self._shown[index] = part
+                else:
+                    with metrics.stage("telegram_send"):
+                        self._messages.append(await self._source.reply_text(part))
+                    self._shown.append(part)
+            except RetryAfter as e:
+                # Limite de Telegram atteinte : on réessaiera plus tard (ou on attend à la fin)
+                if not final:
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+                return await self._flush(final)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+
+        self._flushed_len = len(self._text)
+        self._next_edit = time.monotonic() + self._interval
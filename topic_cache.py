@@ -0,0 +1,93 @@
+import os
+import logging
+import time
+import json
+import threading
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from redis_client import r
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cache local (par processus) et copie Redis partagée entre les instances du bot
+TOPIC_CACHE_SIZE = int(os.getenv("TOPIC_CACHE_SIZE", 10000))
+TOPIC_CACHE_LOCAL_TTL = float(os.getenv("TOPIC_CACHE_LOCAL_TTL", 60))
+TOPIC_CACHE_REDIS_TTL = int(os.getenv("TOPIC_CACHE_REDIS_TTL", 86400))
+
+class LRUCache:
+    """Petit cache LRU avec expiration, utilisable depuis plusieurs threads"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+_local = LRUCache(TOPIC_CACHE_SIZE, TOPIC_CACHE_LOCAL_TTL)
+
+def _redis_key(user_id):
+    return f"user:{user_id}:active_topic"
+
+def remember(user_id, topic_id, title):
+    """Met à jour le cache local (appelé lors de la création d'un sujet)"""
+    _local.put(user_id, (topic_id, title))
+
+def forget(user_id):
+    _local.delete(user_id)
+
+async def get_active_topic(user_id):
+    """Retourne (topic_id, title) depuis le cache local puis Redis, ou None"""
+    cached = _local.get(user_id)
+    metrics.cache_result("topic_local", cached is not None)
+    if cached is not None:
+        return cached
+
+    try:
+        raw = await r.get(_redis_key(user_id))
+    except RedisError as e:
+        logger.warning(f"Cache des sujets indisponible (Redis): {e}")
+        return None
+    metrics.cache_result("topic_redis", raw is not None)
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    topic = (data["topic_id"], data["title"])
+    _local.put(user_id, topic)
+    return topic
+
+async def store_active_topic(user_id, topic_id, title):
+    """Enregistre le sujet actif dans le cache local et dans Redis"""
+    remember(user_id, topic_id, title)
+    try:
+        await r.set(_redis_key(user_id), json.dumps({"topic_id": topic_id, "title": title}), ex=TOPIC_CACHE_REDIS_TTL)
+    except RedisError as e:
+        logger.warning(f"Cache des sujets indisponible (Redis): {e}")
+
+def get_stats():
+    return {"hits": _local.hits, "misses": _local.misses, "size": len(_local._data)}
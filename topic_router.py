@@ -0,0 +1,150 @@
+import os
+import logging
+import asyncio
+import numpy as np
+import ollama_client
+from topic_cache import LRUCache
+from mysql_client import create_topic, get_topic_centroids, update_topic_centroids, run_db
+
+logger = logging.getLogger(__name__)
+
+TOPIC_ROUTER_ENABLED = os.getenv("TOPIC_ROUTER_ENABLED", "1") == "1"
+# Distance cosinus au-delà de laquelle un message ouvre un nouveau sujet
+TOPIC_ROUTER_MAX_DISTANCE = float(os.getenv("TOPIC_ROUTER_MAX_DISTANCE", 0.45))
+# Les messages plus courts ("ok", "merci !") restent dans le sujet en cours
+TOPIC_ROUTER_MIN_WORDS = int(os.getenv("TOPIC_ROUTER_MIN_WORDS", 4))
+TOPIC_ROUTER_CACHE_SIZE = int(os.getenv("TOPIC_ROUTER_CACHE_SIZE", 2000))
+TOPIC_ROUTER_CACHE_TTL = float(os.getenv("TOPIC_ROUTER_CACHE_TTL", 3600))
+# Les centroïdes modifiés sont enregistrés par lots à cet intervalle (secondes), hors du
+# traitement des messages ; un arrêt brutal perd au plus les mises à jour de cet intervalle
+TOPIC_ROUTER_FLUSH_INTERVAL = float(os.getenv("TOPIC_ROUTER_FLUSH_INTERVAL", 30))
+
+class UserTopics:
+    """Centroïdes des sujets d'un utilisateur : une ligne normalisée par sujet"""
+
+    def __init__(self, rows):
+        self.lock = asyncio.Lock()
+        self.topic_ids = []
+        self.titles = []
+        self.counts = []
+        self.dirty = set()   # index des centroïdes non enregistrés
+        vectors = []
+        for topic_id, title, centroid, count in rows:
+            if centroid is None or not count:
+                continue
+            self.topic_ids.append(topic_id)
+            self.titles.append(title)
+            self.counts.append(count)
+            vectors.append(np.frombuffer(centroid, dtype=np.float32))
+        self.matrix = np.vstack(vectors) if vectors else None
+
+    def nearest(self, vector):
+        """(index, distance cosinus) du sujet le plus proche, ou (None, None)"""
+        if self.matrix is None or self.matrix.shape[1] != vector.shape[0]:
+            return None, None
+        similarities = self.matrix @ vector
+        index = int(np.argmax(similarities))
+        return index, 1.0 - float(similarities[index])
+
+    def index_of(self, topic_id):
+        try:
+            return self.topic_ids.index(topic_id)
+        except ValueError:
+            return None
+
+    def add(self, topic_id, title, vector):
+        self.topic_ids.append(topic_id)
+        self.titles.append(title)
+        self.counts.append(1)
+        row = vector[np.newaxis, :]
+        self.matrix = row.copy() if self.matrix is None else np.vstack([self.matrix, row])
+        return len(self.topic_ids) - 1
+
+    def update(self, index, vector):
+        """Moyenne glissante du centroïde avec le nouveau message"""
+        count = self.counts[index]
+        centroid = self.matrix[index] * count + vector
+        self.matrix[index] = _normalize(centroid)
+        self.counts[index] = count + 1
+
+_users = LRUCache(TOPIC_ROUTER_CACHE_SIZE, TOPIC_ROUTER_CACHE_TTL)
+# Utilisateurs ayant des centroïdes non enregistrés ; gardés ici même s'ils sortent du cache
+_dirty = {}
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+async def _load(user_id):
+    topics = _users.get(user_id)
+    if topics is None:
+        # Des centroïdes pas encore enregistrés sont plus récents que ceux en base
+        topics = _dirty.get(user_id)
+        if topics is None:
+            topics = UserTopics(await run_db(get_topic_centroids, user_id))
+        _users.put(user_id, topics)
+    return topics
+
+def _mark_dirty(user_id, topics, index):
+    topics.dirty.add(index)
+    _dirty[user_id] = topics
+
+async def flush():
+    """Enregistre en une requête les centroïdes modifiés depuis le dernier passage"""
+    pending = [(user_id, topics, topics.dirty) for user_id, topics in _dirty.items()]
+    _dirty.clear()
+    rows = []
+    for _, topics, indices in pending:
+        topics.dirty = set()
+        rows.extend((topics.topic_ids[i], topics.matrix[i].tobytes(), topics.counts[i]) for i in indices)
+    if not rows:
+        return
+    try:
+        await run_db(update_topic_centroids, rows)
+    except Exception as e:
+        logger.warning(f"Enregistrement de {len(rows)} centroïde(s) reporté : {e}")
+        for user_id, topics, indices in pending:
+            for index in indices:
+                _mark_dirty(user_id, topics, index)
+
+async def flush_periodically(interval=TOPIC_ROUTER_FLUSH_INTERVAL):
+    """Tâche de fond : enregistre régulièrement les centroïdes modifiés"""
+    while True:
+        await asyncio.sleep(interval)
+        await flush()
+
+def _title_from(message):
+    return message[:50] + "..." if len(message) > 50 else message
+
+async def route(user_id, username, message, active_topic=None):
+    """Sujet (topic_id, title) du message, ou None pour garder le sujet actif
+
+    Le message est rattaché au sujet dont le centroïde est le plus proche ; au-delà
+    de TOPIC_ROUTER_MAX_DISTANCE, un nouveau sujet est créé. Un sujet actif encore
+    sans centroïde (créé avec /newtopic) reçoit le message.
+    """
+    if len(message.split()) < TOPIC_ROUTER_MIN_WORDS and active_topic is not None:
+        return None
+
+    vector = _normalize(await ollama_client.embed(message))
+    topics = await _load(user_id)
+
+    async with topics.lock:
+        if active_topic is not None and topics.index_of(active_topic[0]) is None:
+            # Sujet choisi explicitement par l'utilisateur : il devient le centroïde de ce sujet
+            index = topics.add(active_topic[0], active_topic[1], vector)
+            _mark_dirty(user_id, topics, index)
+            return active_topic
+
+        index, distance = topics.nearest(vector)
+        if index is not None and distance <= TOPIC_ROUTER_MAX_DISTANCE:
+            topics.update(index, vector)
+            _mark_dirty(user_id, topics, index)
+            return topics.topic_ids[index], topics.titles[index]
+
+        title = _title_from(message)
+        topic_id = await run_db(create_topic, user_id, username, title)
+        index = topics.add(topic_id, title, vector)
+        _mark_dirty(user_id, topics, index)
+        return topic_id, title
@@ -0,0 +1,154 @@
+import os
+import logging
+import json
+import asyncio
+from contextlib import asynccontextmanager
+import numpy as np
+import ollama_client
+from mysql_client import get_user_messages_after, get_messages_by_ids, run_db
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "1") == "1"
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "data/vectors")
+# Nombre de messages embeddés par requête Ollama lors de la mise à jour de l'index
+VECTOR_INDEX_BATCH = int(os.getenv("VECTOR_INDEX_BATCH", 32))
+# Lignes comparées à la fois lors d'une recherche (borne la mémoire utilisée)
+VECTOR_SEARCH_CHUNK = int(os.getenv("VECTOR_SEARCH_CHUNK", 65536))
+EMBED_TEXT_LENGTH = 2000
+
+# Un index par utilisateur, en ajout seul :
+#   {user_id}.f32  vecteurs normalisés float32, une ligne par message
+#   {user_id}.ids  identifiants MySQL (int64) des messages, dans le même ordre
+#   {user_id}.json dimension et dernier message indexé
+_locks = {}       # user_id -> [verrou, tâches qui le tiennent ou l'attendent]
+_refreshes = {}   # user_id -> tâche de mise à jour en cours
+
+def _paths(user_id):
+    base = os.path.join(VECTOR_INDEX_DIR, str(user_id))
+    return base + ".f32", base + ".ids", base + ".json"
+
+@asynccontextmanager
+async def _lock(user_id):
+    """Verrou par utilisateur, supprimé dès que plus personne ne le tient ni ne l'attend"""
+    entry = _locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[user_id]
+
+def _read_meta(user_id):
+    meta_path = _paths(user_id)[2]
+    if not os.path.exists(meta_path):
+        return {"dim": None, "count": 0, "watermark": 0}
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _append(user_id, vectors, ids, meta):
+    """Ajoute des lignes puis met à jour les métadonnées (écrites en dernier)"""
+    os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+    vectors_path, ids_path, meta_path = _paths(user_id)
+    count = meta["count"]
+    # Une écriture interrompue laisse des octets au-delà de `count` : ils sont écrasés
+    with open(vectors_path, "ab") as f:
+        f.truncate(count * meta["dim"] * 4)
+        f.write(vectors.astype(np.float32).tobytes())
+    with open(ids_path, "ab") as f:
+        f.truncate(count * 8)
+        f.write(np.asarray(ids, dtype=np.int64).tobytes())
+    meta = dict(meta, count=count + len(ids), watermark=int(ids[-1]))
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    return meta
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _exchange_text(user_msg, bot_msg):
+    return f"Question : {user_msg or ''}\nRéponse : {bot_msg or ''}"[:EMBED_TEXT_LENGTH]
+
+async def refresh(user_id):
+    """Indexe les messages stockés depuis le dernier message indexé"""
+    async with _lock(user_id):
+        meta = await asyncio.to_thread(_read_meta, user_id)
+        while True:
+            rows = await run_db(get_user_messages_after, user_id, meta["watermark"], VECTOR_INDEX_BATCH)
+            if not rows:
+                return meta["count"]
+            vectors = await ollama_client.embed_many([_exchange_text(u, b) for _, u, b in rows])
+            vectors = _normalize_rows(vectors)
+            if meta["dim"] is None:
+                meta["dim"] = vectors.shape[1]
+            meta = await asyncio.to_thread(_append, user_id, vectors, [row[0] for row in rows], meta)
+
+def schedule_refresh(user_id):
+    """Met à jour l'index en tâche de fond (une seule mise à jour à la fois par utilisateur)"""
+    if not VECTOR_INDEX_ENABLED or user_id in _refreshes:
+        return
+
+    async def run():
+        try:
+            await refresh(user_id)
+        except Exception as e:
+            logger.warning(f"Mise à jour de l'index vectoriel impossible pour {user_id}: {e}")
+        finally:
+            del _refreshes[user_id]
+
+    # Référence gardée : une tâche sans référence peut être collectée en cours d'exécution
+    _refreshes[user_id] = asyncio.create_task(run())
+
+async def stop():
+    """Annule les mises à jour en cours et attend leur fin (avant la fermeture du client Ollama)"""
+    tasks = list(_refreshes.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def _search(user_id, query, k):
+    meta = _read_meta(user_id)
+    count, dim = meta["count"], meta["dim"]
+    if not count or dim != query.shape[0]:
+        return []
+    vectors_path, ids_path, _ = _paths(user_id)
+    # Fichiers projetés en mémoire : seules les pages parcourues sont chargées
+    vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dim))
+    ids = np.memmap(ids_path, dtype=np.int64, mode="r", shape=(count,))
+
+    best_scores = np.empty(0, dtype=np.float32)
+    best_rows = np.empty(0, dtype=np.int64)
+    for start in range(0, count, VECTOR_SEARCH_CHUNK):
+        scores = vectors[start:start + VECTOR_SEARCH_CHUNK] @ query
+        if len(scores) > k:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(len(scores))
+        best_scores = np.concatenate([best_scores, scores[top]])
+        best_rows = np.concatenate([best_rows, top + start])
+        if len(best_scores) > k:
+            keep = np.argpartition(best_scores, -k)[-k:]
+            best_scores, best_rows = best_scores[keep], best_rows[keep]
+
+    order = np.argsort(-best_scores)
+    return [(int(ids[best_rows[i]]), float(best_scores[i])) for i in order]
+
+async def search(user_id, text, k=5):
+    """Les k messages passés les plus proches du texte : [(message_id, similarité)]"""
+    query = _normalize_rows([await ollama_client.embed(text)])[0]
+    return await asyncio.to_thread(_search, user_id, query, k)
+
+async def recall(user_id, text, k=5, min_score=0.5):
+    """Échanges passés pertinents : [(message_user, message_bot, timestamp)] du plus proche au moins proche"""
+    hits = [(message_id, score) for message_id, score in await search(user_id, text, k) if score >= min_score]
+    if not hits:
+        return []
+    messages = await run_db(get_messages_by_ids, user_id, [message_id for message_id, _ in hits])
+    return [messages[message_id] for message_id, _ in hits if message_id in messages]
@@ -0,0 +1,209 @@
+import os
+import logging
+import hmac
+import json
+import signal
+import asyncio
+import multiprocessing
+from aiohttp import web
+from redis.exceptions import ResponseError
+from telegram import Bot, Update
+from redis_client import r
+import metrics
+import llm_scheduler
+from logging_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Adresse publique déclarée à Telegram et serveur HTTP local qui la reçoit
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Nombre de shards : chaque chat est toujours traité par le même worker
+WEBHOOK_SHARDS = int(os.getenv("WEBHOOK_SHARDS", 1))
+WEBHOOK_STREAM_MAXLEN = int(os.getenv("WEBHOOK_STREAM_MAXLEN", 100000))
+# Mises à jour en cours de traitement au plus par worker
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", 256))
+# Délai laissé aux mises à jour en cours à l'arrêt d'un worker (secondes)
+WEBHOOK_SHUTDOWN_GRACE = float(os.getenv("WEBHOOK_SHUTDOWN_GRACE", 30))
+
+STREAM_PREFIX = "talkwise:updates"
+CONSUMER_GROUP = "talkwise"
+
+def stream_key(shard):
+    return f"{STREAM_PREFIX}:{shard}"
+
+def chat_id_of(data):
+    """Identifiant du chat d'une mise à jour Telegram brute (None si absent)"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post", "callback_query"):
+        payload = data.get(field)
+        if not payload:
+            continue
+        if field == "callback_query":
+            payload = payload.get("message") or {}
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+def shard_for(chat_id, shards=WEBHOOK_SHARDS):
+    return abs(chat_id) % shards if chat_id is not None else 0
+
+# --- Réception : valide le secret et range la mise à jour dans le stream de son shard
+
+async def handle_update(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    shard = shard_for(chat_id_of(data))
+    await r.xadd(stream_key(shard), {"update": json.dumps(data)},
+                 maxlen=WEBHOOK_STREAM_MAXLEN, approximate=True)
+    return web.Response()
+
+async def run_ingress(token):
+    """Serveur webhook : les mises à jour sont distribuées aux workers via Redis"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL et WEBHOOK_SECRET sont nécessaires en mode webhook")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+
+    async with Bot(token) as bot:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Webhook en écoute sur {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} ({WEBHOOK_SHARDS} shard(s)) ✅")
+    # SIGTERM (docker stop, arrêt par run_webhook) : arrêt propre comme Ctrl+C
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    try:
+        await stopping.wait()
+    finally:
+        await runner.cleanup()
+
+# --- Traitement : un worker par shard, ordre conservé au sein de chaque chat
+
+class ChatSequencer:
+    """Traite les mises à jour de chats différents en parallèle, celles d'un même chat dans l'ordre"""
+
+    def __init__(self):
+        self._locks = {}   # chat_id -> [verrou, tâches qui le tiennent ou l'attendent]
+
+    async def run(self, chat_id, coro):
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Les verrous asyncio sont équitables : l'ordre d'arrivée est respecté
+            async with entry[0]:
+                await coro
+        finally:
+            # Le verrou paraît libre entre deux tâches d'un même chat : seul le compteur
+            # indique qu'aucune n'attend plus
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+async def consume(app, shard, batch_size=100):
+    """Lit le stream du shard et transmet chaque mise à jour à l'application"""
+    key = stream_key(shard)
+    # Un seul worker par shard : nom fixe pour reprendre ses propres messages non acquittés
+    consumer = f"worker-{shard}"
+    try:
+        await r.xgroup_create(key, CONSUMER_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    sequencer = ChatSequencer()
+    tasks = set()
+    in_flight = asyncio.Semaphore(WEBHOOK_MAX_IN_FLIGHT)
+
+    async def process(entry_id, fields):
+        data = json.loads(fields["update"])
+        try:
+            await app.process_update(Update.de_json(data, app.bot))
+        except Exception as e:
+            logger.exception(f"Erreur lors du traitement de la mise à jour {entry_id}: {e}")
+        await r.xack(key, CONSUMER_GROUP, entry_id)
+
+    try:
+        # Reprend d'abord les mises à jour reçues mais non acquittées (redémarrage)
+        last_id = "0"
+        while True:
+            response = await r.xreadgroup(CONSUMER_GROUP, consumer, {key: last_id},
+                                          count=batch_size, block=5000)
+            entries = response[0][1] if response else []
+            if last_id == "0" and not entries:
+                last_id = ">"
+                continue
+            for entry_id, fields in entries:
+                await in_flight.acquire()
+                chat_id = chat_id_of(json.loads(fields["update"]))
+                task = asyncio.create_task(sequencer.run(chat_id, process(entry_id, fields)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: in_flight.release())
+            if last_id == "0" and entries:
+                last_id = entries[-1][0]
+    finally:
+        # Arrêt : les mises à jour en cours se terminent (les autres seront relues au redémarrage)
+        if tasks:
+            await asyncio.wait(tasks, timeout=WEBHOOK_SHUTDOWN_GRACE)
+
+async def run_worker(app, shards):
+    """Démarre l'application sans polling et consomme les shards indiqués"""
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    logger.info(f"Worker lancé pour le(s) shard(s) {', '.join(map(str, shards))} ✅")
+    consumers = asyncio.gather(*(consume(app, shard) for shard in shards))
+    # SIGTERM annule la consommation : l'arrêt ci-dessous écrit la file d'écriture différée
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, consumers.cancel)
+    try:
+        await consumers
+    except asyncio.CancelledError:
+        logger.info("Arrêt du worker demandé")
+    finally:
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+def worker_main(shard, metrics_offset=0):
+    """Point d'entrée d'un processus worker"""
+    from bot import build_application
+    from mysql_client import init_database
+    configure_logging()
+    init_database()
+    # OLLAMA_NUM_PARALLEL borne les générations de tous les workers réunis, pas de chacun
+    llm_scheduler.scheduler.global_slots = llm_scheduler.GlobalSlots(r, llm_scheduler.LLM_MAX_CONCURRENCY)
+    # Plusieurs workers sur la même machine : un port de métriques chacun
+    metrics.start_metrics_server(metrics_offset)
+    try:
+        asyncio.run(run_worker(build_application(), [shard]))
+    except KeyboardInterrupt:
+        pass
+
+def run_webhook(token, workers=WEBHOOK_SHARDS):
+    """Mode webhook complet : réception dans ce processus et un processus worker par shard"""
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker_main, args=(shard, shard + 1), daemon=True) for shard in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(run_ingress(token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
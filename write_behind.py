@@ -0,0 +1,196 @@
+import os
+import logging
+import json
+import time
+import asyncio
+from datetime import datetime
+import metrics
+from mysql_client import insert_messages, run_db
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 100))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 1.0))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", 10000))
+# Après un échec MySQL, les lots partent directement sur disque pendant ce délai
+WRITE_BEHIND_RETRY_DELAY = float(os.getenv("WRITE_BEHIND_RETRY_DELAY", 5.0))
+WRITE_BEHIND_SPILL_PATH = os.getenv("WRITE_BEHIND_SPILL_PATH", "data/messages_spill.jsonl")
+
+# Marqueur de fin déposé dans la file par stop()
+_STOP = object()
+
+class MessageWriter:
+    """File d'écriture différée des échanges vers MySQL, par lots"""
+
+    def __init__(self, batch_size=WRITE_BEHIND_BATCH_SIZE, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 queue_size=WRITE_BEHIND_QUEUE_SIZE, spill_path=WRITE_BEHIND_SPILL_PATH):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self._retry_at = 0.0
+        self.stats = {"written": 0, "batches": 0, "spilled": 0, "replayed": 0, "dropped": 0}
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    async def start(self):
+        """Rejoue les écritures en attente sur disque puis démarre la tâche d'écriture"""
+        try:
+            await self._replay_spill()
+        except Exception as e:
+            # Le bot démarre quand même : le rejeu sera retenté après la prochaine écriture réussie
+            logger.error(f"Rejeu des messages mis de côté impossible au démarrage: {e}")
+        self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, user_id, user_message, bot_reply, username=None, topic_id=None):
+        """Ajoute un échange à la file (attend si la file est pleine)"""
+        record = {
+            "topic_id": topic_id,
+            "user_id": user_id,
+            "username": username or "Unknown",
+            "message_user": user_message,
+            "message_bot": bot_reply,
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+        await self._queue.put(record)
+
+    async def stop(self):
+        """Arrête la tâche et écrit tout ce qui reste dans la file
+
+        La tâche n'est pas annulée : un marqueur de fin lui fait écrire son lot
+        en cours puis s'arrêter, sans perdre les messages déjà retirés de la file.
+        """
+        if self._task is not None:
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+
+        batch = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is _STOP:
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                await self._write(batch)
+                batch = []
+        if batch:
+            await self._write(batch)
+
+    async def _run(self):
+        while True:
+            batch, stopping = await self._next_batch()
+            if batch:
+                try:
+                    await self._write(batch)
+                except Exception as e:
+                    # La tâche doit survivre : sinon la file se remplit et enqueue() bloque les handlers
+                    logger.exception(f"Écriture différée de {len(batch)} message(s) en échec: {e}")
+            if stopping:
+                return
+
+    async def _next_batch(self):
+        """Attend un premier message puis complète le lot jusqu'à la taille ou au délai
+
+        Retourne (lot, arrêt demandé ?).
+        """
+        record = await self._queue.get()
+        if record is _STOP:
+            return [], True
+        batch = [record]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if record is _STOP:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    async def _write(self, batch):
+        if time.monotonic() < self._retry_at:
+            await self._spill(batch)
+            return
+        try:
+            await self._insert(batch)
+        except Exception as e:
+            logger.warning(f"Écriture MySQL différée impossible, {len(batch)} message(s) mis de côté sur disque: {e}")
+            self._retry_at = time.monotonic() + WRITE_BEHIND_RETRY_DELAY
+            await self._spill(batch)
+            return
+        # MySQL répond : on en profite pour rejouer ce qui attendait sur disque
+        await self._replay_spill()
+
+    async def _insert(self, batch):
+        rows = [
+            (rec["topic_id"], rec["user_id"], rec["username"], rec["message_user"],
+             rec["message_bot"], datetime.fromisoformat(rec["timestamp"]))
+            for rec in batch
+        ]
+        with metrics.stage("mysql_insert"):
+            await run_db(insert_messages, rows)
+        self.stats["written"] += len(rows)
+        metrics.WRITE_BEHIND_ROWS.labels("written").inc(len(rows))
+        self.stats["batches"] += 1
+
+    async def _spill(self, batch):
+        def append():
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for rec in batch:
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            await asyncio.to_thread(append)
+        except OSError as e:
+            # Ni MySQL ni le disque : le lot est perdu, mais l'écriture différée continue
+            logger.error(f"{len(batch)} message(s) perdu(s), écriture sur disque impossible ({self.spill_path}): {e}")
+            self.stats["dropped"] += len(batch)
+            metrics.WRITE_BEHIND_ROWS.labels("dropped").inc(len(batch))
+            return
+        self.stats["spilled"] += len(batch)
+        metrics.WRITE_BEHIND_ROWS.labels("spilled").inc(len(batch))
+
+    async def _replay_spill(self):
+        if not os.path.exists(self.spill_path):
+            return
+        # Le fichier est renommé : les nouveaux échecs repartent dans un fichier neuf
+        replay_path = self.spill_path + ".replay"
+        if not os.path.exists(replay_path):
+            os.replace(self.spill_path, replay_path)
+
+        def read_records():
+            records = []
+            with open(replay_path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Dernière ligne tronquée par un arrêt brutal pendant l'écriture
+                        logger.warning(f"Ligne {number} illisible ignorée dans {replay_path}")
+            return records
+        records = await asyncio.to_thread(read_records)
+
+        for i in range(0, len(records), self.batch_size):
+            batch = records[i:i + self.batch_size]
+            try:
+                await self._insert(batch)
+                self.stats["replayed"] += len(batch)
+                metrics.WRITE_BEHIND_ROWS.labels("replayed").inc(len(batch))
+            except Exception as e:
+                logger.warning(f"Rejeu des messages mis de côté interrompu: {e}")
+                self._retry_at = time.monotonic() + WRITE_BEHIND_RETRY_DELAY
+                await self._spill(records[i:])
+                break
+        os.remove(replay_path)